@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+'''
+Benchmark of the reputation base : computeReputation() against computeReputationVectorized() ,
+computeReputation() in a process pool , and the per-file loop used before the packed submit store.
+A temporary TrustPlayersList with random submits is generated , the real one is never touched.
+
+Usage : python benchmark.py [Amount of submits] [Amount of servers]
+'''
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+import mpr
+
+
+def generateSubmits(submit_amount, server_amount, player_amount):
+    '''
+    Generate a TrustPlayersList and weight.json in the working directory.
+    The same submits are also saved one file per submit in LegacyPlayersList , for legacyReputation()
+    '''
+    players = [str(uuid.UUID(int=random.getrandbits(128)))
+               for i in range(player_amount)]
+    weight = {}
+    os.mkdir('TrustPlayersList')
+    for i in range(server_amount):
+        server_uuid = str(uuid.UUID(int=random.getrandbits(128)))
+        weight[server_uuid] = random.choice([0.5, 1, 1.5, 2, 5])
+        os.mkdir('TrustPlayersList/' + server_uuid)
+        os.makedirs('LegacyPlayersList/' + server_uuid)
+        index = {'submits': {}, 'size': 0, 'dead': 0}
+        for j in range(submit_amount // server_amount):
+            submit_uuid = str(uuid.uuid4())
+            entry = {'offset': 0, 'length': 0, 'verified': True,
+                     'server_uuid': server_uuid, 'timestamp': '0',
+                     'player_uuid': random.choice(players),
+                     'points': random.choice([-1.0, -0.8, -0.5, -0.3, 0.2, 0.5, 1.0]),
+                     'comment': 'benchmark'}
+            index['submits'][submit_uuid] = entry
+            with open('LegacyPlayersList/' + server_uuid + '/' + submit_uuid, 'w', encoding='utf-8') as f:
+                f.write('uuid: ' + server_uuid + '\ntimestamp: 0\nplayer_uuid: ' + entry['player_uuid'] +
+                        '\npoints: ' + str(entry['points']) + '\ncomment: benchmark')
+        mpr.saveSubmitIndex(server_uuid, index)
+    with open('weight.json', 'w') as f:
+        f.write(json.dumps(weight, indent=4))
+    return weight
+
+
+def legacyReputation(weight):
+    '''
+    The reputation loop before the packed submit store : every submit file is read and scanned ,
+    its points are weighted and added one by one.
+    Return (reputation, amount, count)
+    '''
+    reputation = {}
+    amount = {}
+    count = 0
+    for server in os.listdir('LegacyPlayersList'):
+        pownum = float(weight.get(server))
+        for submit in os.listdir('LegacyPlayersList/' + server):
+            with open('LegacyPlayersList/' + server + '/' + submit, 'r', encoding='utf-8') as f:
+                content = f.read()
+            uuid_index = content.find('player_uuid:')
+            player_uuid = content[uuid_index + 13:uuid_index + 49]
+            point_index = content.find('points:')
+            point_end_index = point_index + 8
+            while point_end_index < len(content) and content[point_end_index] in '-.0123456789':
+                point_end_index += 1
+            player_point = float(content[point_index + 8:point_end_index]) * pownum
+            if reputation.get(player_uuid) is None:
+                reputation[player_uuid] = player_point
+                amount[player_uuid] = 1
+            else:
+                reputation[player_uuid] = reputation[player_uuid] + player_point
+                amount[player_uuid] += 1
+            count += 1
+    return reputation, amount, count
+
+
+def timeIt(function, weight, repeat=3):
+    '''
+    Run a function with its output hidden , return (result , best time in seconds)
+    '''
+    best = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(repeat):
+            start = time.perf_counter()
+            result = function(weight)
+            used = time.perf_counter() - start
+            if best is None or used < best:
+                best = used
+    return result, best
+
+
+if __name__ == "__main__":
+    submit_amount = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    server_amount = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        print('Generating ' + str(submit_amount) + ' submits from ' +
+              str(server_amount) + ' servers...')
+        weight = generateSubmits(submit_amount, server_amount, submit_amount // 10)
+
+        (legacy, amount, count), legacy_time = timeIt(legacyReputation, weight)
+        (serial, amount, count), serial_time = timeIt(mpr.computeReputation, weight)
+        (vectorized, amount, count), vectorized_time = timeIt(
+            mpr.computeReputationVectorized, weight)
+        jobs = max(2, os.cpu_count() or 1)
+        (parallel, amount, count), parallel_time = timeIt(
+            lambda weight: mpr.computeReputation(weight, jobs), weight)
+
+        different = 0
+        for player_uuid in legacy:
+            for result in (serial, vectorized):
+                if abs(legacy[player_uuid] - result.get(player_uuid, float('inf'))) > 1e-9:
+                    different += 1
+        print('Players : ' + str(len(legacy)) + ' , different results : ' + str(different))
+        print('per-file loop (before)        : {:.3f}s'.format(legacy_time))
+        print('computeReputation()           : {:.3f}s , speedup : {:.1f}x'.format(
+            serial_time, legacy_time / serial_time))
+        print('computeReputationVectorized() : {:.3f}s , speedup : {:.1f}x , {:.1f}x over computeReputation()'.format(
+            vectorized_time, legacy_time / vectorized_time, serial_time / vectorized_time))
+        print('computeReputation(jobs=' + str(jobs) + ')  : {:.3f}s , bit-identical : {}'.format(
+            parallel_time, json.dumps(parallel) == json.dumps(serial)))
+        os.chdir('/')
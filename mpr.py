@@ -7,12 +7,41 @@ import sys
 import time
 import platform
 import base64
+import bisect
+import mmap
 import shutil
+import hashlib
+import codecs
+import gzip
+import tempfile
+import threading
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import gnupg
 import pandas as pd
 import requests
 from retrying import retry
 
+verify_cache = None  # signature verification cache , loaded by loadVerifyCache()
+verify_cache_lock = threading.Lock()
+reputation_log_lock = threading.Lock()  # reputation_changes.log is written by the pull workers
+signer = None  # the signer of this process , loaded by getSigner()
+signer_lock = threading.Lock()
+players_map = None  # uuid >> [name , fetched at] or [None , fetched at , misses] , loaded by loadPlayersMap()
+players_map_pending = []  # new entries not written to players_map.journal yet
+players_map_journal_size = 0  # amount of entries in players_map.journal
+players_map_lock = threading.Lock()
+PLAYERS_MAP_BATCH = 100  # entries written to the journal at a time
+PLAYERS_MAP_COMPACT = 1000  # compact the journal into players_map.json when it has more entries
+PLAYER_NAME_TTL = 30 * 86400  # seconds before a player name is searched again
+PLAYER_MISS_TTL = 86400  # seconds before a player not found is searched again , doubled by every miss
+PLAYER_MISS_TTL_MAX = 30 * 86400
+mojang_bucket = {'tokens': None, 'time': 0.0, 'pause_until': 0.0}  # token bucket of mojang requests
+mojang_bucket_lock = threading.Lock()
+provider_latency = {'mojang': deque(maxlen=200), 'playerdb': deque(maxlen=200)}  # seconds of recent answers
+provider_latency_lock = threading.Lock()
+
 
 def checkArgument():
     '''
@@ -91,6 +120,28 @@ def preSetup():
                         help=argparse.SUPPRESS)  # for update>>pushLocalBanList() , to disable it
     parser.add_argument('-f5', '--function5', action='store_false', default=True,
                         help=argparse.SUPPRESS)  # for update>>autoUndoSubmits() , to disable it
+    parser.add_argument('-j', '--jobs', default='1',
+                        help=argparse.SUPPRESS)  # for update>>pullSubmitFromTrustedServer() , servers pulled at the same time
+    parser.add_argument('-vj', '--vjobs', default='None',
+                        help=argparse.SUPPRESS)  # for update>>pullSubmitFromTrustedServer() , signatures verified at the same time
+    parser.add_argument('-pj', '--pjobs', default='4',
+                        help=argparse.SUPPRESS)  # for push , submits pushed at the same time
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help=argparse.SUPPRESS)  # for update>>pullSubmitFromTrustedServer() and pushLocalBanList() , parse submits while downloading
+    parser.add_argument('--rebuild', action='store_true', default=False,
+                        help=argparse.SUPPRESS)  # for update>>generateReputationBase() , recompute from all submits
+    parser.add_argument('--check', action='store_true', default=False,
+                        help=argparse.SUPPRESS)  # for update>>generateReputationBase() , compare with a full recompute
+    parser.add_argument('--vectorized', action='store_true', default=False,
+                        help=argparse.SUPPRESS)  # for update>>generateReputationBase() , full recompute with pandas
+    parser.add_argument('-rj', '--rjobs', default='1',
+                        help=argparse.SUPPRESS)  # for update>>generateReputationBase() , worker processes of a full recompute
+    parser.add_argument('-a', '--apply', action='store_true', default=False,
+                        help=argparse.SUPPRESS)  # for setweight , apply the new weight to reputation base now
+    parser.add_argument('--fullscan', action='store_true', default=False,
+                        help=argparse.SUPPRESS)  # for update>>generateBanList() , check every player instead of the changed ones
+    parser.add_argument('-t', '--threshold', default='None',
+                        help=argparse.SUPPRESS)  # for candidates , the default is min_point_toban in mprdb.ini
     # register main keys 3/4
     parser.add_argument('--key', action='store_true', default=False,
                         help='>>Used to generate key pair and get lists.With key "-n name -e email -i choice -p passphrase".Choice input y to save and auto fill passphrase in the future,n will not.To get a list of keys, use key "-m list"')
@@ -117,6 +168,10 @@ def preSetup():
     parser.add_argument('--setweight', action='store_true', default=False,
                         help='>>Used to set or change weight for a specific server.With key "-u ServerUUID -w Weight"')
     parser.add_argument('--undo', action='store_true', default=False,help='>>Undo revoked submits')
+    parser.add_argument('--restore', default='None',
+                        help='>>Used to restore the ban list recorded at a time.With value "time" like 20230102-030405 or "#N" for record N , "list" to list the records ,and optional key "-n banlist_path"')
+    parser.add_argument('--candidates', action='store_true', default=False,
+                        help='>>Used to list players that would be banned at a threshold.With an optional key "-t threshold"')
     # load args 4/4
     global args
     args = parser.parse_args()
@@ -184,8 +239,9 @@ def helpInfo():
       [Weight] : It should be in range (0,5].
 
     --setweight
-      Set weight for a specific server : -u [Server UUID] -w [Weight]
+      Set weight for a specific server : -u [Server UUID] -w [Weight] [-a]
       [Weight] : It should be in range (0,5]
+      [-a] : Optional, apply the new weight to reputation base now, no submit will be read again
 
     --detail 
       Get a detail of a submit , from submit uuid : -u [Ubumit UUID]
@@ -194,8 +250,20 @@ def helpInfo():
       List all submits from a server : -u [Server UUID]
     
     --push
-      Push local submits that your server created to remote server : [-n [BanList Path]]
+      Push local submits that your server created to remote server : [-n [BanList Path]] [-vj N] [-pj N]
       [BanList Path] : Optional, to define a ban list, the default is in mpr.ini 
+      [-vj N] [-pj N] : Optional, sign N submits and push N submits at the same time
+
+    --candidates
+      List players that would be banned at a threshold : [-t [Threshold]]
+      [Threshold] : Optional, the default is min_point_toban in mprdb.ini
+
+    --restore
+      Restore the ban list recorded at a time : --restore [Time] [-n [BanList Path]]
+      List the records : --restore list
+      [Time] : Like 20230102-030405 , or a part of it like 20230102 , the last record not later than it is used ,
+               or #N to use the record numbered N in the list
+      [BanList Path] : Optional, the default is in mpr.ini
 
     --update
       Update local and remote ban list.
@@ -207,6 +275,21 @@ def helpInfo():
         push local ban list >> -f4
         auto undo revoked submit >> -f5
 
+        parallel argument : (optional)
+        pull N servers at the same time >> -j N , --jobs N
+        verify or sign N signatures at the same time >> -vj N , --vjobs N (default: cpu cores)
+        push or undo N submits at the same time >> -pj N , --pjobs N (default: 4)
+        parse submit lists while downloading >> --stream
+
+        reputation argument : (optional)
+        recompute reputation base from all submits >> --rebuild
+        compare reputation base with a full recompute >> --check
+        full recompute with pandas , faster on large lists >> --vectorized
+        full recompute in N worker processes >> -rj N , --rjobs N
+
+        ban list argument : (optional)
+        check every player instead of the players changed since the last ban list >> --fullscan
+
     Example ,you only want to generate a new ban list ,use 
     python mpr.py --update -f1 -f2 -f4 -f5 , to disable the other functions
       
@@ -241,6 +324,8 @@ def importKeyFile():
         return 0
 
     import_result = gpg.import_keys(key_data)
+    # the key may have changed , the cached verification results are no longer trusted
+    verifyCacheInvalidate(import_result.fingerprints)
     result = import_result.results
     result = result[0]
     print('Fingerprint: ', result['fingerprint'])
@@ -262,78 +347,88 @@ def tryJsonValid(path):
     return True
 
 
-def autoPush(server_uuid, player_uuid, player_name, points, comment, passphrase):
+def submitMessage(server_uuid, player_uuid, points, comment, timestamp):
     '''
-    Direct push submit without confirming.
-    Push succeed: return 0
-    Push failed: return player_uuid
+    Build the message of a submit , before being signed.
     '''
-    timestamp = str(int(time.time()))
+    return ("uuid: " + server_uuid + '\n' +
+            "timestamp: " + timestamp + '\n' +
+            "player_uuid: " + player_uuid + '\n' +
+            "points: " + str(points) + '\n' +
+            "comment: " + comment)
 
-    # write message
-    with open("message.txt", 'r+', encoding='utf-8') as f:
-        f.truncate(0)
-        f.write("uuid: " + server_uuid + '\n')
-        f.write("timestamp: " + timestamp + '\n')
-        f.write("player_uuid: " + player_uuid + '\n')
-        f.write("points: " + str(points) + '\n')
-        f.write("comment: " + comment)
-
-    conf.read('mprdb.ini')
-    keyid = conf.get('mprdb', 'ServerKeyId')
 
-    conf.read('mprdb.ini')
-    server_uuid = conf.get('mprdb', 'serveruuid')
-    server_name = conf.get('mprdb', 'servername')
+def signPush(item, signer):
+    '''
+    Sign a submit in memory , for pushLocalBanList()
+    item : {'server_uuid' , 'player_uuid' , 'player_name' , 'points' , 'comment'}
+    Return item with 'timestamp' and 'data' , data is None if signing failed.
+    '''
+    item['timestamp'] = str(int(time.time()))
+    message = submitMessage(item['server_uuid'], item['player_uuid'], item['points'],
+                            item['comment'], item['timestamp'])
+    signed = signer.sign(message)
+    item['data'] = signed.encode('utf-8') if signed is not None else None
+    return item
 
-    # sign message
-    with open('message.txt', 'rb') as f:
-        gpg.sign_file(f, keyid=keyid, output='message.txt.asc',
-                      passphrase=passphrase)
 
-    url = "https://test.openmprdb.org/v1/submit/new"
+def putPush(item, attempts=3):
+    '''
+    Put a signed submit to remote server , for pushLocalBanList()
+    item['url'] : the address to put , resolved before the workers start ,
+                  mprdb.ini is not read in worker threads
+    It is put at most attempts times , a retried PUT may save the submit twice.
+    Return item with 'submit_uuid' , it is None if the push failed.
+    '''
+    item['submit_uuid'] = None
+    if item['data'] is None:
+        return item
+    url = item['url']
     headers = {"Content-Type": "text/plain"}
-    with open("message.txt.asc", "r", encoding='utf-8') as f:
-        data = f.read()
-        data = data.encode('utf-8')
-
-    res = putData(url, data, headers)
-    try:
-        response = res.json()
-    except:
-        # print('An error occurred when putting data.')
-        # print(res)
-        # sys.exit(1)
-        return player_uuid
+    delay = 1
+    for attempt in range(attempts):
+        try:
+            # not putData() , it retries by itself , every attempt here is one PUT
+            response = requests.put(url, data=item['data'], headers=headers, timeout=5).json()
+        except:
+            time.sleep(delay)
+            delay *= 2
+            continue
+        if response.get("status") == "OK":
+            item['submit_uuid'] = response.get("uuid")
+        return item
+    return item
 
-    if not os.path.exists('submit.json'):
-        with open('submit.json', 'w+') as f:
-            f.write('{}')
-    commit = {}
 
-    status = response.get("status")
-    if status == "OK":
-        submit_uuid = response.get("uuid")
-        # print("Submitted successfully! The UUID submitted this time is: "+submit_uuid)
-        eventtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+def saveSubmits(commit):
+    '''
+    Save submits that pushed to submit.json
+    '''
+    atomicWrite('submit.json', json.dumps(commit, indent=4, ensure_ascii=False))
+    return 0
 
-        with open('submit.json', 'r', encoding='utf-8') as f:
-            commit = json.loads(f.read())
-        info = {'Name': player_name, 'PlayerUUID': player_uuid, 'Points': points, 'Timestamp': timestamp, 'Time': eventtime,
-                'Comment': comment, 'SubmitUUID': submit_uuid, 'ServerUUID': server_uuid, 'ServerName': server_name}
-        commit[submit_uuid] = info
 
-        with open('submit.json', 'w+', encoding='utf-8') as fd:
-            fd.write(json.dumps(commit, indent=4, ensure_ascii=False))
-        return 0
+def pushedInfo(item, server_name):
+    '''
+    The record of a pushed submit in submit.json
+    '''
+    eventtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    return {'Name': item['player_name'], 'PlayerUUID': item['player_uuid'], 'Points': item['points'],
+            'Timestamp': item['timestamp'], 'Time': eventtime, 'Comment': item['comment'],
+            'SubmitUUID': item['submit_uuid'], 'ServerUUID': item['server_uuid'], 'ServerName': server_name}
 
-    if status == "NG":
-        # print("400 Bad Request or 401 Unauthorized")
-        # print('Status : '+response.get("status"))
-        # print('Reason : '+response.get("reason"))
-        return player_uuid
 
-    return 0
+def diffSets(old, new):
+    '''
+    Compare two collections of uuids with hashed indexes , in O(n+m).
+    Return a dict of sets :
+    added : in new but not in old
+    removed : in old but not in new
+    unchanged : in both
+    '''
+    old = set(old)
+    new = set(new)
+    return {'added': new - old, 'removed': old - new, 'unchanged': old & new}
 
 
 def getRemoteSubmits():
@@ -354,74 +449,144 @@ def getRemoteSubmits():
         pushed_submits_list = []
         pushed_nothing = True
 
-    for submit in pushed_submits_list:
+    try:
+        for submit in pushed_submits_list:
 
-        if pushed_nothing == True:
-            break
+            if pushed_nothing == True:
+                break
 
-        content = submit['content']
-        uuid_index = content.find("player_uuid:")
-        if content[uuid_index + 12] == " ":  # with space
-            player_uuid = content[uuid_index + 13:uuid_index + 49]
-        if content[uuid_index + 12] != " ":  # without space
-            player_uuid = content[uuid_index + 12:uuid_index + 48]
+            try:
+                player_uuid = parseSubmitContent(submit['content'])['player_uuid']
+            except ValueError:  # not a player submit
+                continue
 
-        pushed_submits.append(player_uuid)
+            pushed_submits.append(player_uuid)
+    except (ValueError, requests.exceptions.RequestException):
+        # with --stream the body is parsed here , a broken body must not be taken as a short list
+        print('An error occurred when getting data.')
+        sys.exit(1)
 
     return pushed_submits # contain player uuid
 
-def getLocalBanList():
+class BanList:
     '''
-    Get a local list of players that been banned by your server.
+    A ban list of the minecraft server (banned-players.json) , loaded once.
+    Players are indexed by uuid , so contains , add and remove are O(1).
+    Changed players are tracked , save() only writes when something changed.
     '''
 
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # player uuid >> ban entry , in the order of the file
+        self.dirty = set()  # player uuids added , removed or changed since loaded
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for entry in json.loads(f.read()):
+                    self.entries[entry['uuid']] = entry
+
+    def __contains__(self, player_uuid):
+        return player_uuid in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(list(self.entries.values()))
+
+    def get(self, player_uuid):
+        return self.entries.get(player_uuid)
+
+    def add(self, entry):
+        '''
+        Add a ban entry , return False if the player is already banned.
+        '''
+        if entry['uuid'] in self.entries:
+            return False
+        self.entries[entry['uuid']] = entry
+        self.dirty.add(entry['uuid'])
+        return True
+
+    def remove(self, player_uuid):
+        '''
+        Remove a player , return False if the player is not banned.
+        '''
+        if self.entries.pop(player_uuid, None) is None:
+            return False
+        self.dirty.add(player_uuid)
+        return True
+
+    def local(self):
+        '''
+        Get the uuids of players banned by your server.
+        The entries that get from other servers are skipped , with tag:[MPRDB]
+        '''
+        return [player_uuid for player_uuid in self.entries
+                if self.entries[player_uuid]['reason'].find("[MPRDB]") < 0]
+
+    def changed(self):
+        return len(self.dirty) > 0
+
+    def save(self, path=None):
+        '''
+        Write the ban list atomically if something changed , return True if it was written.
+        '''
+        if not self.changed():
+            return False
+        if path is None:
+            path = self.path
+        # the minecraft server never sees a partially written ban list
+        atomicWrite(path, json.dumps(list(self.entries.values()), indent=4, ensure_ascii=False))
+        self.dirty.clear()
+        return True
+
+
+def localBanListPath():
+    '''
+    Get the path of local ban list , from input args first , then the mprdb.ini
+    Return None if both are invalid.
+    '''
     conf.read('mprdb.ini')
     args_path = args.name  # get file path from args
     ini_path = conf.get('mprdb', 'banlist_path')
-
-    # get ban list path
-    # get it from input args first , then the mprdb.ini
     if tryJsonValid(args_path):
-        banlist_path = args_path
+        return args_path
     elif tryJsonValid(ini_path):
-        banlist_path = ini_path
-    else:
-        print('Local ban list is invalid!')
-        return 0
+        return ini_path
+    return None
+
+
+def getLocalBanList(ban_list=None):
+    '''
+    Get a local list of players that been banned by your server.
+    ban_list : a loaded BanList , if it is None , the local ban list is loaded
+    '''
+    if ban_list is None:
+        banlist_path = localBanListPath()
+        if banlist_path is None:
+            print('Local ban list is invalid!')
+            return 0
+        ban_list = BanList(banlist_path)
 
-    # read the local ban list
     # the submit that get from other servers will be skip. with tag:[MPRDB]
-    local_ban_list = []  # saved all submit uuid that local saved now
-    with open(banlist_path, 'r', encoding='utf-8') as f:
-        ban_list = json.loads(f.read())
-    for submit in ban_list:
-        reason = submit['reason']
-        if reason.find("[MPRDB]") >= 0:
-            continue
-        else:
-            local_ban_list.append(submit['uuid'])
+    return ban_list.local()  # contain player uuid
 
-    return local_ban_list # contain player uuid
 
 def autoUndoSubmit():
     '''
     If a player was removed from the ban list.
     We will undo all the submits about this player.
+    Signing and deleting are pipelined like pushLocalBanList() ,
+    submit.json and submit-others.json are read once and saved every 100 submits.
     '''
-    error_uuid = []
     count = 0
-    undo_nothing = False
     wait_to_undo = []
     
     pushed_submits = getRemoteSubmits()
     local_ban_list = getLocalBanList()
 
     # compair the two list
-    # if remote submit is not in local ban list, save to list: wait_to_undo
-    wait_to_undo_players = []
-    for uuid in pushed_submits:
-        if uuid not in local_ban_list:
-            wait_to_undo_players.append(uuid) # the player that waits to undo
+    # if remote submit is not in local ban list, it waits to undo
+    wait_to_undo_players = diffSets(pushed_submits, local_ban_list)['removed'] # the player that waits to undo
 
     with open('submit.json', 'r', encoding='utf-8') as f:
         submit = json.loads(f.read())
@@ -435,16 +600,46 @@ def autoUndoSubmit():
         print('Nothing new to undo.')
         return 0
 
+    conf.read('mprdb.ini')
+    server_uuid = conf.get('mprdb', 'serveruuid')
+    server_name = conf.get('mprdb', 'servername')
+    api_url = apiUrl()
+    signer = getSigner()
+    sign_jobs = loadVerifyJobs()
+    push_jobs = loadPushJobs()
+
+    commit = {}
+    if tryJsonValid('submit-others.json'):
+        with open('submit-others.json', 'r', encoding='utf-8') as f:
+            commit = json.loads(f.read())
+
     comment = '[MPRDB] Auto Undo'
-    for uuid in wait_to_undo:
-        result = autoDeleteSubmit(uuid,comment)
-        # print(result)
-        if result != 0:
-            error_uuid.append(uuid)
-        count += 1
-        precent = count / len(wait_to_undo) * 100
-        # print(precent)
-        progressController(precent)
+    failed = set()
+    with ThreadPoolExecutor(max_workers=sign_jobs) as sign_pool, ThreadPoolExecutor(max_workers=push_jobs) as deleter:
+        signing = []
+        for uuid in wait_to_undo:
+            item = {'delete_uuid': uuid, 'comment': comment, 'api_url': api_url}
+            signing.append(sign_pool.submit(signUndo, item, signer))
+        deleting = []
+        for future in as_completed(signing):
+            deleting.append(deleter.submit(deleteUndo, future.result()))
+        for future in as_completed(deleting):
+            item = future.result()
+            if item['submit_uuid'] is None:
+                failed.add(item['delete_uuid'])
+            else:
+                commit[item['submit_uuid']] = undoneInfo(item, submit[item['delete_uuid']], server_name, server_uuid)
+            count += 1
+            if count % 100 == 0:  # do not lose the undone submits if it is stopped
+                saveSubmitsOthers(commit)
+
+            precent = count / len(wait_to_undo) * 100
+            # print(precent)
+            progressController(precent)
+    saveSubmitsOthers(commit)
+
+    # in the order of submit.json
+    error_uuid = [uuid for uuid in wait_to_undo if uuid in failed]
 
     if len(error_uuid) > 0:
         print('\nThe following submits were not able to undo.')
@@ -462,63 +657,71 @@ def pushLocalBanList():
     '''
     conf.read('mprdb.ini')
     server_uuid = conf.get('mprdb', 'serveruuid')
-    args_path = args.name  # get file path from args
-    ini_path = conf.get('mprdb', 'banlist_path')
-    error_uuid = []
     count = 0
-    pushed_nothing = False
 
-    # get ban list path
-    # get it from input args first , then the mprdb.ini
-    if tryJsonValid(args_path):
-        banlist_path = args_path
-    elif tryJsonValid(ini_path):
-        banlist_path = ini_path
-    else:
+    banlist_path = localBanListPath()
+    if banlist_path is None:
         print('Local ban list is invalid!')
         return 0
 
-    pushed_submits = getRemoteSubmits()
-    local_ban_list = getLocalBanList()
-
-    # read the local ban list
+    # read the local ban list once
     # the submit that get from other servers will be skip. with tag:[MPRDB]
-    with open(banlist_path, 'r', encoding='utf-8') as f:
-        ban_list = json.loads(f.read())
+    ban_list = BanList(banlist_path)
+    pushed_submits = getRemoteSubmits()
+    local_ban_list = getLocalBanList(ban_list)
 
     # compair the two list
-    # if local submit not saved in remote server, save to list: wait_to_push
-    wait_to_push = []
-    for items in local_ban_list:
-        if items not in pushed_submits:
-            wait_to_push.append(items)
+    # if local submit not saved in remote server, it waits to push
+    wait_to_push = diffSets(pushed_submits, local_ban_list)['added']
 
     print('Pushing:', len(wait_to_push), 'item(s)')
     if len(wait_to_push) == 0:
         print('Nothing new to push.')
         return 0
 
-    passphrase = loadPassphrase()
-
-    for submit in ban_list:
-        # scan the local ban list, if it is in the wait_to_push, load the submit info
-        if submit['uuid'] in wait_to_push:
-            comment = submit['reason']
-            player_name = submit['name']
-            player_uuid = submit['uuid']
-            points = '-1'
+    signer = getSigner()  # the key is unlocked once for all submits
+    server_name = conf.get('mprdb', 'servername')
+    sign_jobs = loadVerifyJobs()
+    push_jobs = loadPushJobs()
+    url = apiUrl() + "/v1/submit/new"
 
-            # print(server_uuid,player_uuid,player_name,points,comment,passphrase)
-            result = autoPush(server_uuid, player_uuid,
-                              player_name, points, comment, passphrase)
+    commit = {}
+    if tryJsonValid('submit.json'):
+        with open('submit.json', 'r', encoding='utf-8') as f:
+            commit = json.loads(f.read())
 
-            if result != 0:
-                error_uuid.append(player_uuid)
+    # signing and pushing are pipelined , a submit is pushed as soon as it is signed
+    failed = set()
+    with ThreadPoolExecutor(max_workers=sign_jobs) as sign_pool, ThreadPoolExecutor(max_workers=push_jobs) as pusher:
+        signing = []
+        for player_uuid in local_ban_list:
+            # scan the local ban list in its order, if it is in the wait_to_push, load the submit info
+            if player_uuid not in wait_to_push:
+                continue
+            submit = ban_list.get(player_uuid)
+            item = {'server_uuid': server_uuid, 'player_uuid': player_uuid, 'player_name': submit['name'],
+                    'points': '-1', 'comment': submit['reason'], 'url': url}
+            signing.append(sign_pool.submit(signPush, item, signer))
+        pushing = []
+        for future in as_completed(signing):
+            pushing.append(pusher.submit(putPush, future.result()))
+        for future in as_completed(pushing):
+            item = future.result()
+            if item['submit_uuid'] is None:
+                failed.add(item['player_uuid'])
+            else:
+                commit[item['submit_uuid']] = pushedInfo(item, server_name)
             count += 1
+            if count % 100 == 0:  # do not lose the pushed submits if it is stopped
+                saveSubmits(commit)
 
-        precent = count / len(wait_to_push) * 100
-        # print(precent)
-        progressController(precent)
+            precent = count / len(wait_to_push) * 100
+            # print(precent)
+            progressController(precent)
+    saveSubmits(commit)
+
+    # in the order of the local ban list
+    error_uuid = [player_uuid for player_uuid in local_ban_list if player_uuid in failed]
 
     if len(error_uuid) > 0:
         print('\nThe following players were not able to push.')
@@ -779,11 +982,67 @@ def loadPassphrase():
     return passphrase
 
 
-def generateRegisterJson():
+class Signer:
+    '''
+    Sign messages in memory with the server key , no file is written.
+    The key id and passphrase are loaded once. gpg is run once per signature , the passphrase is sent every time.
+    '''
+
+    def __init__(self, keyid=None, passphrase=None):
+        conf.read('mprdb.ini')
+        self.keyid = keyid if keyid is not None else conf.get('mprdb', 'ServerKeyId')
+        self.passphrase = passphrase if passphrase is not None else loadPassphrase()
+        self.warmed = False
+
+    def warm(self):
+        '''
+        Sign an empty message once , to find out a wrong key or passphrase before anything is sent.
+        Return False if the key or passphrase is wrong.
+        '''
+        if not self.warmed:
+            self.warmed = self.sign('') is not None
+        return self.warmed
+
+    def sign(self, message):
+        '''
+        Sign a message , return the clear signed text , or None if signing failed.
+        '''
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        signed = gpg.sign(message, keyid=self.keyid, passphrase=self.passphrase)
+        if not signed.data:
+            return None
+        return signed.data.decode('utf-8')
+
+
+def getSigner():
+    '''
+    Get the signer of this process , it is created once and its key is checked with warm().
+    Exit if the key can not be used.
+    '''
+    global signer
+    with signer_lock:
+        if signer is None:
+            signer = Signer()
+            if not signer.warm():
+                print('Failed to sign file. Check your key and passphrase.')
+                sys.exit(1)
+    return signer
+
+
+def revokeMessage(ticks, comment):
+    '''
+    Build the message to delete a submit or a server , before being signed.
+    '''
+    return "timestamp: " + ticks + "\n" + "comment: " + comment
+
+
+def generateRegisterJson(signed):
     '''
     Generate register json in a correct format
 
     Read file line by line and add '\n' in the end , then join them in one line.
+    signed : the signed message
     '''
     public_key = ''
     with open('public_key.asc', 'r') as f:
@@ -792,10 +1051,9 @@ def generateRegisterJson():
             public_key = public_key + line + '\n'
 
     message = ''
-    with open('message.txt.asc', 'r') as f:
-        for line in f:
-            line = line.strip()
-            message = message + line + '\n'
+    for line in signed.splitlines():
+        line = line.strip()
+        message = message + line + '\n'
 
     data = json.dumps({'message': message, 'public_key': public_key},
                       sort_keys=True, indent=2, separators=(',', ': '))
@@ -820,25 +1078,14 @@ def registerServer():
     if server_name == 'None':
         print('Invalid server name.')
         return 0
-    passphrase = loadPassphrase()
-    # write message info : server_name
-    with open("message.txt", 'r+', encoding='utf-8') as f:
-        f.truncate(0)
-        f.write("server_name:" + server_name)
-    # get keyid
-    conf.read('mprdb.ini')
-    keyid = conf.get('mprdb', 'ServerKeyId')
-    # sign message
-    with open('message.txt', 'rb') as f:
-        gpg.sign_file(f, keyid=keyid, output='message.txt.asc',
-                      passphrase=passphrase)
-    # check output file exists
-    if not os.path.exists('message.txt.asc'):
+    # sign message info : server_name
+    signed = getSigner().sign("server_name:" + server_name)
+    if signed is None:
         print('Failed to sign file. Check your key and passphrase.')
         sys.exit(1)
     # put data
-    data = generateRegisterJson()
-    url = "https://test.openmprdb.org/v1/server/register"
+    data = generateRegisterJson(signed)
+    url = apiUrl() + "/v1/server/register"
     headers = {"Content-Type": "application/json"}
     res = putData(url, data, headers)
 
@@ -865,15 +1112,115 @@ def registerServer():
     return 0
 
 
+def apiUrl():
+    '''
+    Get the address of the OpenMPRDB server , it can be changed with api_url in mprdb.ini
+    '''
+    conf.read('mprdb.ini')
+    return conf.get('mprdb', 'api_url', fallback='https://test.openmprdb.org').rstrip('/')
+
+
 @retry(stop_max_attempt_number=5)
-def getData(url):
+def getData(url, headers=None, stream=False):
     '''
     Request method: GET
+    With stream=True , the body is not downloaded until it is read.
     '''
-    response = requests.get(url, timeout=5)
+    response = requests.get(url, headers=headers, timeout=5, stream=stream)
     return response
 
 
+def iterJsonArray(response, key):
+    '''
+    Read a json object from a streaming response , yield the items of the array `key` one by one.
+    Only the item being parsed and one chunk of the body are kept in memory.
+    The response is closed when the generator ends , fails or is dropped.
+    '''
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = response.iter_content(chunk_size=65536)
+    state = {'buf': '', 'pos': 0}
+
+    def fill():
+        # drop what has been parsed and read the next chunk , return False at the end of body
+        state['buf'] = state['buf'][state['pos']:]
+        state['pos'] = 0
+        for chunk in chunks:
+            state['buf'] += text_decoder.decode(chunk)
+            return True
+        state['buf'] += text_decoder.decode(b'', final=True)
+        return False
+
+    def peek():
+        # return the next char that is not a whitespace
+        while True:
+            buf = state['buf']
+            pos = state['pos']
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                raise ValueError('Unexpected end of json stream')
+
+    def expect(char):
+        if peek() != char:
+            raise ValueError('Invalid json stream , expect ' + char)
+        state['pos'] += 1
+
+    def value():
+        peek()
+        while True:
+            buf = state['buf']
+            pos = state['pos']
+            if buf[pos] not in '{["':
+                # numbers and literals have no closing char , make sure the whole token has been read
+                end = pos
+                while end < len(buf) and buf[end] not in ',]} \t\r\n':
+                    end += 1
+                if end == len(buf) and fill():
+                    continue
+            try:
+                obj, end = decoder.raw_decode(state['buf'], state['pos'])
+            except json.JSONDecodeError:
+                if not fill():
+                    raise
+                continue
+            state['pos'] = end
+            return obj
+
+    try:
+        expect('{')
+        if peek() == '}':
+            return
+        while True:
+            name = value()
+            expect(':')
+            if name == key and peek() == '[':
+                expect('[')
+                if peek() == ']':
+                    state['pos'] += 1
+                else:
+                    while True:
+                        yield value()
+                        if peek() == ',':
+                            state['pos'] += 1
+                            continue
+                        expect(']')
+                        break
+            else:
+                value()
+            if peek() == ',':
+                state['pos'] += 1
+                continue
+            expect('}')
+            return
+    finally:
+        # the body is not needed any more , give the connection back
+        response.close()
+
+
 def getPlayerName(uuid):
     # get player name from uuid
     url = "https://sessionserver.mojang.com/session/minecraft/profile/" + uuid
@@ -959,29 +1306,15 @@ def newSubmit():
     except:
         sys.exit(0)
 
-    # write message
-    with open("message.txt", 'r+', encoding='utf-8') as f:
-        f.truncate(0)
-        f.write("uuid: " + server_uuid + '\n')
-        f.write("timestamp: " + ticks + '\n')
-        f.write("player_uuid: " + player_uuid + '\n')
-        f.write("points: " + str(score) + '\n')
-        f.write("comment: " + comment)
-
-    conf.read('mprdb.ini')
-    keyid = conf.get('mprdb', 'ServerKeyId')
-    passphrase = loadPassphrase()
-
     # sign message
-    with open('message.txt', 'rb') as f:
-        gpg.sign_file(f, keyid=keyid, output='message.txt.asc',
-                      passphrase=passphrase)
+    data = getSigner().sign(submitMessage(server_uuid, player_uuid, score, comment, ticks))
+    if data is None:
+        print('Failed to sign file. Check your key and passphrase.')
+        sys.exit(1)
+    data = data.encode('utf-8')
 
-    url = "https://test.openmprdb.org/v1/submit/new"
+    url = apiUrl() + "/v1/submit/new"
     headers = {"Content-Type": "text/plain"}
-    with open("message.txt.asc", "r", encoding='utf-8') as f:
-        data = f.read()
-        data = data.encode('utf-8')
 
     res = putData(url, data, headers)
     try:
@@ -1017,79 +1350,59 @@ def newSubmit():
 
     return 0
 
-def autoDeleteSubmit(delete_uuid,comment):
+def signUndo(item, signer):
     '''
-    Delete a submit that has been submitted.
-    No confirm info will be shown
+    Sign the revocation of a submit in memory , for autoUndoSubmit()
+    item : {'delete_uuid' , 'comment'}
+    Return item with 'timestamp' and 'data' , data is None if signing failed.
     '''
-    # writing message
-    ticks = str(int(time.time()))
-    with open("message.txt", 'r+') as f:
-        f.truncate(0)
-        f.write("timestamp: " + ticks)
-        f.write("\n")
-        f.write("comment: " + comment)
-
-    conf.read('mprdb.ini')
-    keyid = conf.get('mprdb', 'ServerKeyId')
-    passphrase = loadPassphrase()
-    # sign message
-    with open('message.txt', 'rb') as f:
-        gpg.sign_file(f, keyid=keyid, output='message.txt.asc',
-                      passphrase=passphrase)
-    
-    with open("message.txt.asc", "r") as f:
-        data = f.read()
-    url = "https://test.openmprdb.org/v1/submit/uuid/" + delete_uuid
-    headers = {"Content-Type": "text/plain"}
+    item['timestamp'] = str(int(time.time()))
+    signed = signer.sign(revokeMessage(item['timestamp'], item['comment']))
+    item['data'] = signed.encode('utf-8') if signed is not None else None
+    return item
 
-    res = deleteData(url, data, headers)
 
+def deleteUndo(item):
+    '''
+    Delete a signed submit from remote server , for autoUndoSubmit()
+    item['api_url'] : the address of the OpenMPRDB server , resolved before the workers start ,
+                      mprdb.ini is not read in worker threads
+    Return item with 'submit_uuid' of the revocation , it is None if the delete failed.
+    '''
+    item['submit_uuid'] = None
+    if item['data'] is None:
+        return item
+    url = item['api_url'] + "/v1/submit/uuid/" + item['delete_uuid']
+    headers = {"Content-Type": "text/plain"}
     try:
-        response = res.json()
+        response = deleteData(url, item['data'], headers).json()
     except:
-        return delete_uuid
-
-    commit = {}
-    with open('submit-others.json', 'r', encoding='utf-8') as f:
-        commit = json.loads(f.read())
-
-
-    # load local server name and server uuid from local file
-    conf.read('mprdb.ini')
-    server_uuid = conf.get('mprdb', 'serveruuid')
-    server_name = conf.get('mprdb', 'servername')
-    
-    if not os.path.exists('submit-others.json'):
-        with open('submit-others.json', 'w+') as f:
-            f.write('{}')
+        return item
+    if response.get("status") == "OK":
+        item['submit_uuid'] = response.get("uuid")
+    return item
 
-    with open('submit.json', 'r', encoding='utf-8') as f:
-        submit = json.loads(f.read())
 
-    # check status
-    status = response.get("status")
-    if status == "OK":
-        submit_uuid = response.get("uuid")
-        # print("Deleted commit successfully! The UUID submitted this time is: "+submit_uuid)
-        eventtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        info = {'Type': "Delete server", 'ServerName': server_name, 'ServerUUID': server_uuid,
-                'Points withdrawn': submit[delete_uuid]["Points"],
-                'Original reason': submit[delete_uuid]["Comment"],
-                'Playername': submit[delete_uuid]["Name"], 'Timestamp': ticks, 'Time': eventtime,
-                'Reason for revocation': comment, 'SubmitUUID': submit_uuid}
-        commit[submit_uuid] = info
-        with open('submit-others.json', 'w+', encoding='utf-8') as fd:
-            fd.write(json.dumps(commit, indent=4, ensure_ascii=False))
+def undoneInfo(item, submit, server_name, server_uuid):
+    '''
+    The record of an undone submit in submit-others.json
+    submit : the record of the submit in submit.json
+    '''
+    eventtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    return {'Type': "Delete server", 'ServerName': server_name, 'ServerUUID': server_uuid,
+            'Points withdrawn': submit["Points"], 'Original reason': submit["Comment"],
+            'Playername': submit["Name"], 'Timestamp': item['timestamp'], 'Time': eventtime,
+            'Reason for revocation': item['comment'], 'SubmitUUID': item['submit_uuid']}
 
-    if status == "NG":
-        return delete_uuid
-        # print("Submit not found in remote server , or Unauthorized")
-        # print('Status : '+response.get("status"))
-        # print('Reason : '+response.get("reason"))
 
+def saveSubmitsOthers(commit):
+    '''
+    Save deleted submits to submit-others.json
+    '''
+    atomicWrite('submit-others.json', json.dumps(commit, indent=4, ensure_ascii=False))
     return 0
 
+
 def deleteSubmit():
     '''
     Delete a submit that has been submitted.
@@ -1126,28 +1439,16 @@ def deleteSubmit():
     except:
         sys.exit(0)
 
-    # writing message
-    ticks = str(int(time.time()))
-    with open("message.txt", 'r+') as f:
-        f.truncate(0)
-        f.write("timestamp: " + ticks)
-        f.write("\n")
-        f.write("comment: " + comment)
-
-    conf.read('mprdb.ini')
-    keyid = conf.get('mprdb', 'ServerKeyId')
-    passphrase = loadPassphrase()
     # sign message
-    with open('message.txt', 'rb') as f:
-        gpg.sign_file(f, keyid=keyid, output='message.txt.asc',
-                      passphrase=passphrase)
-
-    with open("message.txt.asc", "r") as f:
-        data = f.read()
-    url = "https://test.openmprdb.org/v1/submit/uuid/" + delete_uuid
+    ticks = str(int(time.time()))
+    data = getSigner().sign(revokeMessage(ticks, comment))
+    if data is None:
+        print('Failed to sign file. Check your key and passphrase.')
+        sys.exit(1)
+    url = apiUrl() + "/v1/submit/uuid/" + delete_uuid
     headers = {"Content-Type": "text/plain"}
 
-    res = deleteData(url, data, headers)
+    res = deleteData(url, data.encode('utf-8'), headers)
 
     try:
         response = res.json()
@@ -1216,29 +1517,16 @@ def deleteServer():
     except:
         sys.exit(0)
 
-    # writing message
-    ticks = str(int(time.time()))
-    with open("message.txt", 'r+') as f:
-        f.truncate(0)
-        f.write("timestamp: " + ticks)
-        f.write("\n")
-        f.write("comment: " + comment)
-
-    conf.read('mprdb.ini')
-    keyid = conf.get('mprdb', 'ServerKeyId')
-    passphrase = loadPassphrase()
-
     # sign message
-    with open('message.txt', 'rb') as f:
-        gpg.sign_file(f, keyid=keyid, output='message.txt.asc',
-                      passphrase=passphrase)
-
-    with open("message.txt.asc", "r") as f:
-        data = f.read()
-    url = "https://test.openmprdb.org/v1/server/uuid/" + server_uuid
+    ticks = str(int(time.time()))
+    data = getSigner().sign(revokeMessage(ticks, comment))
+    if data is None:
+        print('Failed to sign file. Check your key and passphrase.')
+        sys.exit(1)
+    url = apiUrl() + "/v1/server/uuid/" + server_uuid
     headers = {"Content-Type": "text/plain"}
 
-    res = deleteData(url, data, headers)
+    res = deleteData(url, data.encode('utf-8'), headers)
 
     try:
         response = res.json()
@@ -1278,7 +1566,7 @@ def listServer():
     Use --max to limit the amount to display.
     '''
     max = str(args.max)
-    url = "https://test.openmprdb.org/v1/server/list" + "?limit=" + max
+    url = apiUrl() + "/v1/server/list" + "?limit=" + max
 
     print("Getting servers list...")
     print("The last " + max + " servers will be displayed.")
@@ -1313,6 +1601,7 @@ def weightServer(server_uuid, weight):
 
     with open("weight.json", "w") as fp:
         fp.write(json.dumps(key_list, indent=4))
+    logReputationChanges([{'op': 'weight', 'server': server_uuid}])
     return 0
 
 
@@ -1331,7 +1620,7 @@ def serverInfoMap(id, info: str):
             id[16:20] + '-' + id[20:]  # change 32 bits id to 36 bits
         return id  # return 36uuid
 
-    url = "https://test.openmprdb.org/v1/server/list"
+    url = apiUrl() + "/v1/server/list"
     res = getData(url)
     try:
         response = res.json()
@@ -1398,6 +1687,8 @@ def importKey(server_uuid):
     filepath = "./TrustPublicKey/" + server_uuid  # import key file
     key_data = open(filepath).read()
     import_result = gpg.import_keys(key_data)
+    # the key may have changed , the cached verification results are no longer trusted
+    verifyCacheInvalidate(import_result.fingerprints, server_uuid)
     result = import_result.results
     result = result[0]
     print('Fingerprint: ' + result['fingerprint'])
@@ -1466,6 +1757,7 @@ def getDetailListFromServer(mode: str, serverid='None'):
     mode can be normal or call
     If you call this function in main function , set mode to normal , it will display a list. 
     If you call this function in other function , set mode to call , put a uuid, is will return the submit dict.
+    With --stream in call mode , response['submits'] is a generator that yields submits while downloading.
     '''
     if serverid == 'None':  # if it did not receive serverid , it will get it from the args input
         serverid = args.uuid
@@ -1473,7 +1765,12 @@ def getDetailListFromServer(mode: str, serverid='None'):
     else:
         server_uuid = serverid
 
-    url = "https://test.openmprdb.org/v1/submit/server/" + server_uuid
+    url = apiUrl() + "/v1/submit/server/" + server_uuid
+
+    if mode == 'call' and args.stream:
+        # submits are parsed one by one while the body is being downloaded
+        res = getData(url, stream=True)
+        return {'submits': iterJsonArray(res, 'submits')}
 
     res = getData(url)
     try:
@@ -1502,7 +1799,7 @@ def getSubmitDetail():
     Get a submit detail by a submit uuid
     '''
     submit_uuid = args.uuid
-    url = "https://test.openmprdb.org/v1/submit/uuid/" + submit_uuid
+    url = apiUrl() + "/v1/submit/uuid/" + submit_uuid
 
     res = getData(url)
     try:
@@ -1524,117 +1821,576 @@ def getSubmitDetail():
     return 0
 
 
-def deleteRevokedSubmit(local_submit, remote_submit, server_uuid):
+def deleteRevokedSubmit(index, remote_submit, server_uuid):
     '''
     Delete the local submits that have been revoked in remote server.
+    The packed store is compacted if too much space is taken by revoked submits ,
+    otherwise the index is saved by the caller.
     '''
-    for items in local_submit:
-        if items not in remote_submit:
-            os.remove('TrustPlayersList/'+server_uuid+'/'+items)
-            print('Revoked submit: '+items)
+    removed = diffSets(index['submits'], remote_submit)['removed']
+    if len(removed) == 0:
+        return 0
+    revoked = []
+    for items in index['submits']:  # keep the order of the index
+        if items in removed:
+            revoked.append(items)
+    changes = []  # for the reputation base
+    for items in revoked:
+        entry = index['submits'][items]
+        index['dead'] += entry['length']
+        changes.append({'op': 'revoke', 'server': server_uuid, 'submit': items, 'seq': nextLogSeq(index),
+                        'player_uuid': entry['player_uuid'], 'points': entry['points']})
+        del index['submits'][items]
+        print('Revoked submit: '+items)
+    # the log is written before the index , see logReputationChanges()
+    logReputationChanges(changes)
+    if index['dead'] * 4 >= index['size']:
+        compactSubmitStore(server_uuid, index)
     return 0
 
 
-def pullSubmitFromTrustedServer():
+def loadSubmitIndex(server_uuid):
     '''
-    Pull submits from trusted servers
+    Load the index of the packed submit store of a server.
+    TrustPlayersList/<server_uuid>/submits.pack : contents of the submits , append only
+    TrustPlayersList/<server_uuid>/index.json : submit uuid >> offset , length , verified flag ,
+        and the parsed record : server uuid , timestamp , player uuid , points , comment ,
+        log_seq : the number of the last change logged for this server , commit_seq : see saveSubmitIndex()
+    Submits saved as one file per submit by older versions are migrated into the store.
     '''
-    start = time.time()
-    count = 0
-    submit_count = 0
-    server_count = 0
-
-    file_dir = "TrustPublicKey"
-    key_list = os.listdir(file_dir)  # list
-    error_key = []
-    error_code = []
-    server_all_count = len(key_list)
-    error_submit = []
-    error_submit_server = []
-    error_submit_server_count = 0
-
-    # load the keys that prepared to pull
-    for key in key_list:
-        server_error = False
-        server_count += 1
-        submit_count = 0
-        remote_submit = []
-        # print("=====================")
-        print("\nNow loading server :" + key + " --<Server:" +
-              str(server_count) + "/" + str(server_all_count) + ">")
-        url = "https://test.openmprdb.org/v1/submit/server/" + key
-        response = getData(url)
-
-        if response.status_code >= 400:
-            print("HTTP status code: " + str(response.status_code))
-            print("\nAn error occurred. Please try again later.")
-            print("This key may be no longer available. Skip...")
-            error_key.append(key)
-            error_code.append(response.status_code)
+    path_name = 'TrustPlayersList/' + server_uuid
+    if not os.path.exists(path_name):
+        os.makedirs(path_name)
+    index = {'submits': {}, 'size': 0, 'dead': 0}
+    if tryJsonValid(path_name + '/index.json'):
+        with open(path_name + '/index.json', 'r', encoding='utf-8') as f:
+            index = json.loads(f.read())
+
+    # indexes saved by older versions have no parsed records , parse them once
+    old_entry = []
+    for items in index['submits']:
+        if 'comment' not in index['submits'][items]:
+            old_entry.append(items)
+    if len(old_entry) > 0:
+        for items in old_entry:
+            entry = index['submits'][items]
+            entry.update({'server_uuid': None, 'timestamp': None,
+                          'player_uuid': None, 'points': None, 'comment': None})
+            try:
+                entry.update(parseSubmitContent(readSubmit(server_uuid, index, items)))
+            except ValueError:
+                pass
+        saveSubmitIndex(server_uuid, index)
+
+    # one-time migration from the old layout : TrustPlayersList/<server_uuid>/<submit_uuid>
+    loose_submit = []
+    for items in os.listdir(path_name):
+        if items in ('submits.pack', 'index.json') or items.startswith('.tmp-'):
             continue
+        loose_submit.append(items)
+    if len(loose_submit) > 0:
+        print('Migrating ' + str(len(loose_submit)) +
+              ' submit<s> of server ' + server_uuid + ' into the packed store...')
+        records = []
+        for items in loose_submit:
+            with open(path_name + '/' + items, 'r', encoding='utf-8') as f:
+                records.append((items, f.read()))
+        appendSubmits(server_uuid, index, records)
+        for items in loose_submit:
+            os.remove(path_name + '/' + items)
+    return index
+
+
+def saveSubmitIndex(server_uuid, index):
+    '''
+    Save the index of the packed submit store of a server ,
+    then log that the changes numbered up to index['log_seq'] are in the store , if there are new ones.
+    commit_seq : log_seq of the last index saved , a change is committed once
+    '''
+    commit = index.get('log_seq', 0) != index.get('commit_seq', 0)
+    index['commit_seq'] = index.get('log_seq', 0)
+    atomicWrite('TrustPlayersList/' + server_uuid + '/index.json', json.dumps(index))
+    if commit:
+        logReputationChanges([{'op': 'commit', 'server': server_uuid, 'seq': index['log_seq']}])
+    return 0
 
-        res = response.json()
-        submits = res["submits"]
-        submit_all_count = len(submits)
-        local_submit = os.listdir('TrustPlayersList/' + key)
 
-        for items in submits:  # decrypt
-            submit_count += 1
-            submit_uuid = items["uuid"]
+def nextLogSeq(index):
+    '''
+    Number the next change of a server for reputation_changes.log , see logReputationChanges()
+    '''
+    index['log_seq'] = index.get('log_seq', 0) + 1
+    return index['log_seq']
 
-            remote_submit.append(submit_uuid)
-            if submit_uuid in local_submit:
-                continue
 
-            server_uuid = items["server_uuid"]
-            content = items["content"]
-            # print("Now solving submit: " + submit_uuid + " --<Submit:" + str(submit_count) + "/" + str(submit_all_count) + ">" + " --<Server:" + str(server_count) + "/" + str(server_all_count) + ">" + '\n')
-            progressController(submit_count/submit_all_count * 100)
-            with open("temp.txt", 'w+', encoding='utf-8') as f:
-                f.write(content)
-
-            # result = subprocess.check_output("gpg --decrypt temp.txt", shell=True, stderr=subprocess.STDOUT,
-            # stdin=subprocess.PIPE)  # gpg shell's output can't be got completely
-            verify = False
-            with open('temp.txt', 'rb') as f:
-                verified = gpg.verify_file(f)
-            if not verified:
-                verify = False
+def appendSubmits(server_uuid, index, records, save=True):
+    '''
+    Append verified submits to the packed store of a server , then save the index.
+    records : a list of (submit_uuid, content) , or (submit_uuid, content, parsed fields) if it was parsed
+    save : False to leave the index to the caller , a pull saves it once per server ,
+           a tail of the pack that was never indexed is counted as dead by the next append
+    '''
+    if len(records) == 0:
+        return 0
+    pack_path = 'TrustPlayersList/' + server_uuid + '/submits.pack'
+    changes = []  # for the reputation base
+    with open(pack_path, 'ab') as f:
+        # the pack may have a tail that was written but never indexed , count it as dead
+        offset = f.seek(0, os.SEEK_END)
+        index['dead'] += offset - index['size']
+        for record in records:
+            submit_uuid, content = record[0], record[1]
+            data = content.encode('utf-8')
+            f.write(data)
+            # the content is parsed only once , by the verifier or here , later stages only use the index
+            entry = {'offset': offset, 'length': len(data), 'verified': True,
+                     'server_uuid': None, 'timestamp': None,
+                     'player_uuid': None, 'points': None, 'comment': None}
+            if len(record) > 2:
+                for field in ('server_uuid', 'timestamp', 'player_uuid', 'points', 'comment'):
+                    if field in record[2]:
+                        entry[field] = record[2][field]
             else:
-                verify = True
-
-            if verify:
-                # print("Good Signature. Saving....")
-                path_name = './TrustPlayersList/' + server_uuid
-                if not os.path.exists(path_name):
-                    os.makedirs(path_name)
                 try:
-                    os.rename('temp.txt', submit_uuid)
-                    shutil.move(submit_uuid, path_name)
-                except:
-                    # print("Already Saved.Skip..")
-                    os.remove(submit_uuid)
-                count += 1
-            else:
-                # print(str(submit_uuid) + " is not valid! skip...")
-                error_submit.append(submit_uuid)
-                error_submit_server.append(key)
-                server_error = True
-        if server_error:
-            error_submit_server_count += 1
-        deleteRevokedSubmit(local_submit, remote_submit, key)
+                    entry.update(parseSubmitContent(content))
+                except ValueError:
+                    pass
+            if submit_uuid in index['submits']:
+                old = index['submits'][submit_uuid]
+                index['dead'] += old['length']
+                changes.append({'op': 'revoke', 'server': server_uuid, 'submit': submit_uuid, 'seq': nextLogSeq(index),
+                                'player_uuid': old['player_uuid'], 'points': old['points']})
+            index['submits'][submit_uuid] = entry
+            changes.append({'op': 'add', 'server': server_uuid, 'submit': submit_uuid, 'seq': nextLogSeq(index),
+                            'player_uuid': entry['player_uuid'], 'points': entry['points']})
+            offset += len(data)
+        f.flush()
+        os.fsync(f.fileno())
+    index['size'] = offset
+    # the log is written before the index , see logReputationChanges()
+    logReputationChanges(changes)
+    if save:
+        saveSubmitIndex(server_uuid, index)
+    return 0
 
-    # print error servers
-    if len(error_key) >= 1:
-        print("\n\nThere was a problem pulling submissions from the following " +
-              str(len(error_key)) + " server<s>")
-        i = 0
-        for items in error_key:
-            print("Server UUID: " + str(items) +
-                  " ,HTTPcode=" + str(error_code[i]))
-            i += 1
-    # else:
-        # print("All servers responded correctly.")
+
+def readSubmit(server_uuid, index, submit_uuid):
+    '''
+    Read the content of a submit from the packed store of a server.
+    '''
+    entry = index['submits'][submit_uuid]
+    with open('TrustPlayersList/' + server_uuid + '/submits.pack', 'rb') as f:
+        f.seek(entry['offset'])
+        data = f.read(entry['length'])
+    return data.decode('utf-8')
+
+
+def compactSubmitStore(server_uuid, index):
+    '''
+    Rewrite the packed store of a server without the revoked submits.
+    '''
+    path_name = 'TrustPlayersList/' + server_uuid
+    fd, temp_path = tempfile.mkstemp(dir=path_name, prefix='.tmp-')
+    offset = 0
+    try:
+        with open(path_name + '/submits.pack', 'rb') as old, os.fdopen(fd, 'wb') as new:
+            for submit_uuid, entry in sorted(index['submits'].items(), key=lambda x: x[1]['offset']):
+                old.seek(entry['offset'])
+                new.write(old.read(entry['length']))
+                entry['offset'] = offset
+                offset += entry['length']
+            new.flush()
+            os.fsync(new.fileno())
+        os.replace(temp_path, path_name + '/submits.pack')
+    except:
+        os.remove(temp_path)
+        raise
+    index['size'] = offset
+    index['dead'] = 0
+    saveSubmitIndex(server_uuid, index)
+    return 0
+
+
+def loadVerifyCache():
+    '''
+    Load the signature verification cache from verify_cache.json.
+    servers : server uuid >> fingerprint of its key
+    results : fingerprint >> sha256 of submit content >> verification result and parsed fields ,
+              the parsed fields are saved to the store without parsing the content again
+    '''
+    global verify_cache
+    with verify_cache_lock:
+        if verify_cache is not None:
+            return verify_cache
+        cache = {'servers': {}, 'results': {}}
+        if tryJsonValid('verify_cache.json'):
+            with open('verify_cache.json', 'r', encoding='utf-8') as f:
+                cache = json.loads(f.read())
+        verify_cache = cache
+    return verify_cache
+
+
+def saveVerifyCache():
+    '''
+    Save the signature verification cache to verify_cache.json , atomically.
+    It is saved after every server pulled , an interrupted pull keeps the results of servers done.
+    '''
+    if verify_cache is None:
+        return 0
+    with verify_cache_lock:
+        data = json.dumps(verify_cache)
+    atomicWrite('verify_cache.json', data)
+    return 0
+
+
+def verifyCacheGet(server_uuid, digest):
+    '''
+    Get a cached verification result , return None if not cached.
+    '''
+    cache = loadVerifyCache()
+    with verify_cache_lock:
+        fingerprint = cache['servers'].get(server_uuid)
+        if fingerprint is None:
+            return None
+        return cache['results'].get(fingerprint, {}).get(digest)
+
+
+def verifyCachePut(server_uuid, digest, fingerprint, entry):
+    '''
+    Save a verification result to the cache.
+    entry : {'valid'} and the parsed fields of a good submit , see verifySubmit()
+    A bad signature is only cached when the key of the server is known.
+    '''
+    cache = loadVerifyCache()
+    with verify_cache_lock:
+        if fingerprint is None:
+            fingerprint = cache['servers'].get(server_uuid)
+            if fingerprint is None:
+                return 0
+        else:
+            cache['servers'][server_uuid] = fingerprint
+        cache['results'].setdefault(fingerprint, {})[digest] = entry
+    return 0
+
+
+def verifyCacheInvalidate(fingerprints, server_uuid=None):
+    '''
+    Drop the cached results of the keys re-imported.
+    '''
+    cache = loadVerifyCache()
+    with verify_cache_lock:
+        for fingerprint in fingerprints:
+            cache['results'].pop(fingerprint, None)
+        for server in list(cache['servers']):
+            if server == server_uuid or cache['servers'][server] in fingerprints:
+                del cache['servers'][server]
+    saveVerifyCache()
+    return 0
+
+
+def atomicWrite(path, data):
+    '''
+    Write text or bytes to a file atomically.
+    The data is written to a temp file in the same folder , then replaces the target ,
+    so a reader never sees a partially written file.
+    '''
+    dir_name = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=dir_name, prefix='.tmp-')
+    try:
+        if isinstance(data, bytes):
+            f = os.fdopen(fd, 'wb')
+        else:
+            f = os.fdopen(fd, 'w', encoding='utf-8')
+        with f:
+            f.write(data)
+        # keep the permission of the old file , the temp file is only readable by its owner
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path)
+        else:
+            os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+    return 0
+
+
+def verifySubmit(items):
+    '''
+    Verify the signature of a submit , used by the verifier pool.
+    The content is verified in memory , nothing is written to disk here.
+    Return (entry , digest)
+    entry : {'valid'} , with the parsed fields of the content if the signature is good
+    digest : sha256 of the content
+    Results are cached in verify_cache.json , a cached submit will not be verified by gpg again.
+    '''
+    server_uuid = items["server_uuid"]
+    content = items["content"]
+
+    # the same content signed by the same key has been verified before
+    data = content.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()
+    cached = verifyCacheGet(server_uuid, digest)
+    if cached is not None:
+        return cached, digest
+
+    verified = gpg.verify(data)
+    if not verified:
+        entry = {'valid': False}
+        verifyCachePut(server_uuid, digest, None, entry)
+        return entry, digest
+    entry = {'valid': True}
+    try:
+        entry.update(parseSubmitContent(content))
+    except ValueError:
+        pass
+    fingerprint = getattr(verified, 'pubkey_fingerprint', None) or verified.fingerprint
+    verifyCachePut(server_uuid, digest, fingerprint, entry)
+    return entry, digest
+
+
+def pullServer(key, server_count, server_all_count, verifier, api_url, show_progress=True):
+    '''
+    Pull submits from one trusted server , verify them and save the good ones.
+    Signatures are verified by the verifier pool.
+    api_url : the address of the OpenMPRDB server , resolved once before the pull threads start
+    A server that did not change since the last good pull is skipped.
+    Return a dict with the HTTP error code (None if the server responded well)
+    and the submits that could not be verified.
+    '''
+    result = {'key': key, 'error_code': None,
+              'error_submit': [], 'count': 0}
+    submit_count = 0
+    remote_submit = []
+
+    print("\nNow loading server :" + key + " --<Server:" +
+          str(server_count) + "/" + str(server_all_count) + ">")
+    index = loadSubmitIndex(key)
+    local_submit = index['submits']
+
+    # conditional request , the validators are saved in the index of the last good pull
+    headers = {}
+    if index.get('etag'):
+        headers['If-None-Match'] = index['etag']
+    if index.get('last_modified'):
+        headers['If-Modified-Since'] = index['last_modified']
+    url = api_url + "/v1/submit/server/" + key
+    response = getData(url, headers, stream=args.stream)
+
+    if response.status_code == 304:
+        print("Not modified. Skip...")
+        response.close()
+        return result
+
+    if response.status_code >= 400:
+        print("HTTP status code: " + str(response.status_code))
+        print("\nAn error occurred. Please try again later.")
+        print("This key may be no longer available. Skip...")
+        result['error_code'] = response.status_code
+        response.close()
+        return result
+
+    if args.stream:
+        # submits are handed to the verifier pool while the body is being downloaded
+        submits = iterJsonArray(response, 'submits')
+        submit_all_count = 0
+        digest = None
+    else:
+        res = response.json()
+        submits = res["submits"]
+        submit_all_count = len(submits)
+
+        # if the server does not support conditional requests ,
+        # the same submit uuids as the last good pull means nothing changed
+        digest = submitDigest(item["uuid"] for item in submits)
+        if digest == index.get('digest'):
+            print("Not modified. Skip...")
+            response.close()
+            return result
+
+    # the new submits are verified in the verifier pool ,
+    # at most window_size of them are waiting , then they are saved in order
+    window = deque()
+    window_size = loadVerifyJobs() * 4
+    records = []
+    try:
+        for items in submits:
+            submit_count += 1
+            submit_uuid = items["uuid"]
+            remote_submit.append(submit_uuid)
+            if submit_uuid in local_submit:
+                continue
+            if show_progress and submit_all_count > 0:
+                progressController(submit_count/submit_all_count * 100)
+            window.append((items, verifier.submit(verifySubmit, items)))
+            if len(window) >= window_size:
+                collectVerified(window.popleft(), records, result)
+            if len(records) >= 500:
+                # the index is saved once at the end , rewriting it every 500 submits is quadratic
+                appendSubmits(key, index, records, False)
+                records = []
+    except (ValueError, requests.exceptions.RequestException):
+        # the list of remote submits is not complete , nothing can be revoked this time
+        print("\nAn error occurred while reading submits. Please try again later.")
+        result['error_code'] = 'broken stream'
+    while len(window) > 0:
+        collectVerified(window.popleft(), records, result)
+    appendSubmits(key, index, records, False)
+    if result['error_code'] is not None:
+        saveSubmitIndex(key, index)
+        return result
+    deleteRevokedSubmit(index, remote_submit, key)
+    if digest is None:
+        digest = submitDigest(remote_submit)
+
+    # the validators are only saved if all submits are good ,
+    # or the bad ones would never be verified and reported again
+    if len(result['error_submit']) == 0:
+        index['etag'] = response.headers.get('ETag')
+        index['last_modified'] = response.headers.get('Last-Modified')
+        index['digest'] = digest
+    else:
+        index['etag'] = index['last_modified'] = index['digest'] = None
+    saveSubmitIndex(key, index)
+    return result
+
+
+def collectVerified(pending, records, result):
+    '''
+    Wait for the verification of a submit , save the good one to records.
+    pending : (submit , future of verifySubmit)
+    '''
+    items, future = pending
+    submit_uuid = items["uuid"]
+    entry, digest = future.result()
+    if entry['valid']:
+        # print("Good Signature. Saving....")
+        records.append((submit_uuid, items["content"], entry))
+        result['count'] += 1
+    else:
+        # print(str(submit_uuid) + " is not valid! skip...")
+        result['error_submit'].append(submit_uuid)
+    return 0
+
+
+def submitDigest(submit_uuids):
+    '''
+    Digest of a set of submit uuids , the order does not matter.
+    '''
+    sha = hashlib.sha256()
+    for submit_uuid in sorted(submit_uuids):
+        sha.update(submit_uuid.encode('utf-8'))
+        sha.update(b'\n')
+    return sha.hexdigest()
+
+
+def loadJobs():
+    '''
+    Load the amount of workers from argument --jobs , at least 1.
+    '''
+    try:
+        jobs = int(args.jobs)
+    except:
+        print('Invalid argument --jobs . It should be an integer.')
+        sys.exit(1)
+    if jobs < 1:
+        print('Invalid argument --jobs . It should be at least 1.')
+        sys.exit(1)
+    return jobs
+
+
+def loadVerifyJobs():
+    '''
+    Load the amount of signature verifiers from argument --vjobs ,
+    default to the amount of cpu cores.
+    '''
+    if args.vjobs == 'None':
+        return os.cpu_count() or 1
+    try:
+        verify_jobs = int(args.vjobs)
+    except:
+        print('Invalid argument --vjobs . It should be an integer.')
+        sys.exit(1)
+    if verify_jobs < 1:
+        print('Invalid argument --vjobs . It should be at least 1.')
+        sys.exit(1)
+    return verify_jobs
+
+
+def loadPushJobs():
+    '''
+    Load the amount of push workers from argument --pjobs , at least 1.
+    '''
+    try:
+        push_jobs = int(args.pjobs)
+    except:
+        print('Invalid argument --pjobs . It should be an integer.')
+        sys.exit(1)
+    if push_jobs < 1:
+        print('Invalid argument --pjobs . It should be at least 1.')
+        sys.exit(1)
+    return push_jobs
+
+
+def pullSubmitFromTrustedServer():
+    '''
+    Pull submits from trusted servers
+    With --jobs N , N servers will be pulled at the same time.
+    With --vjobs N , N signatures will be verified at the same time ,
+    the default is the amount of cpu cores.
+    '''
+    file_dir = "TrustPublicKey"
+    key_list = os.listdir(file_dir)  # list
+    error_key = []
+    error_code = []
+    server_all_count = len(key_list)
+    error_submit = []
+    error_submit_server = []
+    error_submit_server_count = 0
+    jobs = loadJobs()
+    verify_jobs = loadVerifyJobs()
+
+    # load the keys that prepared to pull
+    # progress bar is only shown when pulling one server at a time
+    show_progress = jobs == 1
+    # mprdb.ini is read here , not in the pull threads , the config parser is shared
+    api_url = apiUrl()
+    # every verification forks its own gpg process , so threads are enough to use all cores
+    with ThreadPoolExecutor(max_workers=verify_jobs) as verifier, ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        server_count = 0
+        for key in key_list:
+            server_count += 1
+            futures.append(executor.submit(
+                pullServer, key, server_count, server_all_count, verifier, api_url, show_progress))
+        for future in as_completed(futures):
+            future.result()
+            saveVerifyCache()
+        # collect the results in the order of key_list , so the summary stays the same
+        results = [future.result() for future in futures]
+
+    for result in results:
+        if result['error_code'] is not None:
+            error_key.append(result['key'])
+            error_code.append(result['error_code'])
+            continue
+        for submit_uuid in result['error_submit']:
+            error_submit.append(submit_uuid)
+            error_submit_server.append(result['key'])
+        if len(result['error_submit']) > 0:
+            error_submit_server_count += 1
+
+    # print error servers
+    if len(error_key) >= 1:
+        print("\n\nThere was a problem pulling submissions from the following " +
+              str(len(error_key)) + " server<s>")
+        i = 0
+        for items in error_key:
+            print("Server UUID: " + str(items) +
+                  " ,HTTPcode=" + str(error_code[i]))
+            i += 1
+    # else:
+        # print("All servers responded correctly.")
     # print("=====================")
 
     # print error submits
@@ -1656,194 +2412,1456 @@ def pullSubmitFromTrustedServer():
     return 0
 
 
-def generateReputationBase():
+def parseSubmitContent(content):
     '''
-    Generate local reputation base
+    Parse the content of a submit in one pass , the fields can be in any order.
+    The content can be the whole clearsigned message or only its cleartext.
+    Return a dict : {'server_uuid', 'timestamp', 'player_uuid', 'points', 'comment'}
+    Raise ValueError if player uuid or points is missing.
     '''
-    reputation = {}
-    start = time.time()
+    record = {'server_uuid': None, 'timestamp': None,
+              'player_uuid': None, 'points': None, 'comment': None}
+    names = {'uuid': 'server_uuid', 'timestamp': 'timestamp', 'player_uuid': 'player_uuid',
+             'points': 'points', 'comment': 'comment'}
+    armored = content.lstrip().startswith('-----BEGIN PGP SIGNED MESSAGE-----')
+    in_header = armored  # armor headers like "Hash: SHA256" end with a blank line
+    comment = None
+    for line in content.splitlines():
+        if armored:
+            if line.startswith('-----BEGIN PGP SIGNED MESSAGE-----'):
+                continue
+            if line.startswith('-----BEGIN PGP SIGNATURE-----'):
+                break
+            if in_header:
+                if line.strip() == '':
+                    in_header = False
+                continue
+            if line.startswith('- '):  # dash-escaped line
+                line = line[2:]
+        name, sep, value = line.partition(':')
+        name = name.strip()
+        # the comment may have more than one line , a line is part of it
+        # unless it sets a field that has not been set yet
+        if sep == '' or name not in names or name == 'comment' or record[names[name]] is not None:
+            if comment is not None:
+                comment.append(line)
+            elif sep != '' and name == 'comment':
+                comment = [value.strip()]
+            continue
+        record[names[name]] = value.strip()
+    if comment is not None:
+        record['comment'] = '\n'.join(comment)
+    if record['player_uuid'] is None or record['points'] is None:
+        raise ValueError('Invalid submit content')
+    record['points'] = float(record['points'])
+    return record
+
+
+def reputationPartial(server, show_progress=False):
+    '''
+    Sum the points of every player in one server , before being weighted.
+    It can run in a worker process.
+    Return (partial, amount, count, log_seq)
+    partial : player uuid >> sum of points from this server
+    amount : player uuid >> amount of submits about this player , from this server
+    count : amount of submits solved
+    log_seq : number of the last change logged for this server , the sums include it
+    '''
+    partial = {}
+    amount = {}
     count = 0
+    # player uuid and points were parsed when the submit was saved , no submit is read here
+    index = loadSubmitIndex(server)
+    submit_list = index['submits']  # submit list
+    submit_amount = len(submit_list)
+    submit_count = 0
+    for submit in submit_list:
+        entry = submit_list[submit]
+        submit_count += 1
+        if entry['player_uuid'] is None:  # content could not be parsed
+            continue
+        player_uuid = entry['player_uuid']
 
-    # load weight file
-    with open("weight.json", 'r') as f:
-        weight = json.loads(f.read())
+        # If the player is not in the partial sums, create a new record.
+        # If it is, add it to the original value.
+        if partial.get(player_uuid) is None:
+            partial[player_uuid] = entry['points']
+            amount[player_uuid] = 1
+        else:
+            partial[player_uuid] = partial[player_uuid] + entry['points']
+            amount[player_uuid] += 1
+        count += 1
+        if show_progress:
+            progressController(submit_count/submit_amount * 100)
+    return partial, amount, count, index.get('log_seq', 0)
 
-    file_dir = "TrustPlayersList"
-    server_list = os.listdir(file_dir)  # server list
 
+def checkServerWeight(weight, server_list):
+    '''
+    Exit if a server has no weight set.
+    '''
     for server in server_list:
-        submit_list = os.listdir(file_dir + "/" + server)  # submit list
-
         if weight.get(server) is None:
             print("Server : " + server + " has no weight set.")
             input("Press any key to exit")
             sys.exit(0)
-        else:
-            # The weight of each trusted server is different
-            pownum = float(weight.get(server))
-            submit_amount = len(submit_list)
-
-        for submit in submit_list:
-            submit_dir = file_dir + "/" + server + "/" + submit
-            with open(submit_dir, 'r', encoding='utf-8') as f:
-                content = f.read()
-            uuid_index = content.find("player_uuid:")
-            if content[uuid_index + 12] == " ":  # with space
-                player_uuid = content[uuid_index + 13:uuid_index + 49]
-            if content[uuid_index + 12] != " ":  # without space
-                player_uuid = content[uuid_index + 12:uuid_index + 48]
-            point_index = content.find("points:")
-            if content[point_index + 7] == " ":  # with space
-                i = 0
-                while True:  # get point number,accept decimals
-                    i += 1
-                    point_end_index = point_index + 7 + i
-                    if content[point_end_index] == "." or content[point_end_index] == "-":
-                        continue
-                    try:
-                        int(content[point_end_index])
-                    except:
-                        break
-                # point before being weighted
-                player_point_ori: float = float(
-                    content[point_index + 8:point_end_index])
-                # point after being weighted
-                player_point = float(
-                    content[point_index + 8:point_end_index]) * pownum
-            if content[point_index + 7] != " ":  # without space
-                i = 0
-                while True:  # get point number,accept decimals
-                    i += 1
-                    point_end_index = point_index + 6 + i
-                    # Handle decimal points and minus signs
-                    if content[point_end_index] == "." or content[point_end_index] == "-":
-                        continue
-                    try:
-                        int(content[point_end_index])
-                    except:
-                        break
-                player_point_ori = float(
-                    content[point_index + 7:point_end_index])
-                player_point = float(
-                    content[point_index + 7:point_end_index]) * pownum
-                # print(player_point)
+    return 0
+
+
+def computeServerSums(weight, jobs=1):
+    '''
+    Sum the points of every server in TrustPlayersList , before being weighted.
+    With jobs > 1 , servers are summed in a process pool , the result is the same as jobs = 1 , bit by bit.
+    Return a dict : server uuid >> (partial, amount, count, log_seq) , see reputationPartial()
+    '''
+    server_list = sorted(os.listdir("TrustPlayersList"))  # server list
+    checkServerWeight(weight, server_list)
+
+    server_sums = {}
+    if jobs == 1:
+        for server in server_list:
+            server_sums[server] = reputationPartial(server, True)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = []
+            for server in server_list:
+                futures.append(executor.submit(reputationPartial, server))
+            done = 0
+            for future in as_completed(futures):
+                done += 1
+                progressController(done/len(futures) * 100)
+            # keep the order of server_list , not the order they finished
+            for server, future in zip(server_list, futures):
+                server_sums[server] = future.result()
+    return server_sums
+
+
+def loadSubmitTable(server_list, seqs=None):
+    '''
+    Load the parsed submits of the servers into one table (server , player_uuid , points).
+    Submits whose content could not be parsed are left out.
+    seqs : if given , server uuid >> log_seq of its index is saved here
+    '''
+    frames = []
+    for server in server_list:
+        index = loadSubmitIndex(server)
+        if seqs is not None:
+            seqs[server] = index.get('log_seq', 0)
+        submit_list = index['submits']
+        if len(submit_list) == 0:
+            continue
+        entries = submit_list.values()
+        frame = pd.DataFrame({'player_uuid': [entry['player_uuid'] for entry in entries],
+                              'points': [entry['points'] for entry in entries]})
+        frame['server'] = server
+        frames.append(frame)
+    if len(frames) == 0:
+        return pd.DataFrame({'server': [], 'player_uuid': [], 'points': []})
+    table = pd.concat(frames, ignore_index=True)
+    table = table[table['player_uuid'].notna()]  # content could not be parsed
+    table['points'] = table['points'].astype(float)
+    return table
+
+
+def computeServerSumsVectorized(weight, table=None, seqs=None):
+    '''
+    Sum the points of every server with pandas , the same sums as computeServerSums().
+    The table of submits is summed by server and player in one grouped aggregation.
+    table , seqs : see loadSubmitTable() , they are loaded here if the table is not given
+    '''
+    server_list = sorted(os.listdir("TrustPlayersList"))  # server list
+    checkServerWeight(weight, server_list)
+    if table is None:
+        seqs = {}
+        table = loadSubmitTable(server_list, seqs)
 
+    server_sums = {}
+    for server in server_list:
+        server_sums[server] = ({}, {}, 0, seqs[server])
+    if len(table) == 0:
+        return server_sums
+    # sort=False keeps the players in the order they first appear , like computeServerSums()
+    grouped = table.groupby(['server', 'player_uuid'], sort=False)['points'].agg(['sum', 'count'])
+    for server, part in grouped.groupby(level=0, sort=False):
+        players = part.index.get_level_values(1)
+        point_count = part['count'].tolist()
+        server_sums[server] = (dict(zip(players, part['sum'].tolist())),
+                               dict(zip(players, point_count)), sum(point_count), seqs[server])
+    return server_sums
+
+
+def mergeServerSums(server_sums, weight):
+    '''
+    Merge the sums of every server with their weights , in the order of server uuid.
+    Each sum is weighted once , not each submit , so values may differ in the last digits
+    from versions before the packed submit store , which added every weighted point one by one.
+    Return (reputation, amount, count)
+    reputation : player uuid >> points after being weighted
+    amount : player uuid >> amount of submits about this player
+    count : amount of submits solved
+    '''
+    reputation = {}
+    amount = {}
+    count = 0
+    for server in sorted(server_sums):
+        partial, part_amount, part_count = server_sums[server][:3]
+        # The weight of each trusted server is different
+        pownum = float(weight.get(server))
+        for player_uuid in partial:
+            # point after being weighted
+            player_point = partial[player_uuid] * pownum
             # If the player is not in the local reputation library, create a new record.
             # If it is, add it to the original value.
             if reputation.get(player_uuid) is None:
                 reputation[player_uuid] = player_point
-                sump = player_point
+                amount[player_uuid] = part_amount[player_uuid]
+            else:
+                reputation[player_uuid] = reputation[player_uuid] + player_point
+                amount[player_uuid] += part_amount[player_uuid]
+        count += part_count
+    return reputation, amount, count
+
+
+def computeReputation(weight, jobs=1):
+    '''
+    Compute the reputation base from all submits in TrustPlayersList.
+    Return (reputation, amount, count) , see mergeServerSums()
+    '''
+    return mergeServerSums(computeServerSums(weight, jobs), weight)
+
+
+def computeReputationVectorized(weight, table=None):
+    '''
+    Compute the reputation base from all submits in TrustPlayersList , with pandas.
+    The table of submits is joined with weight.json , then summed by player in one grouped aggregation.
+    table : see loadSubmitTable() , it is loaded here if not given
+    Return (reputation, amount, count) , see mergeServerSums()
+    '''
+    server_list = sorted(os.listdir("TrustPlayersList"))  # server list
+    checkServerWeight(weight, server_list)
+    if table is None:
+        table = loadSubmitTable(server_list)
+    if len(table) == 0:
+        return {}, {}, 0
+
+    weights = pd.DataFrame({'server': list(weight.keys()),
+                            'weight': [float(items) for items in weight.values()]})
+    table = table.merge(weights, on='server', how='left')
+    table['weighted'] = table['points'] * table['weight']
+    # sort=False keeps the players in the order they first appear , like computeReputation()
+    grouped = table.groupby('player_uuid', sort=False)['weighted'].agg(['sum', 'count'])
+    reputation = dict(zip(grouped.index, grouped['sum'].tolist()))
+    amount = dict(zip(grouped.index, grouped['count'].tolist()))
+    return reputation, amount, len(table)
+
+
+def fullReputation(weight):
+    '''
+    Compute the reputation base and the sums of every server from all submits ,
+    with pandas if --vectorized is set , in --rjobs worker processes if it is more than 1.
+    Return (server_sums, reputation, amount, count) , see computeServerSums() and mergeServerSums()
+    '''
+    if args.vectorized:
+        server_list = sorted(os.listdir("TrustPlayersList"))  # server list
+        checkServerWeight(weight, server_list)
+        seqs = {}
+        table = loadSubmitTable(server_list, seqs)  # loaded once for both
+        reputation, amount, count = computeReputationVectorized(weight, table)
+        return computeServerSumsVectorized(weight, table, seqs), reputation, amount, count
+    server_sums = computeServerSums(weight, loadReputationJobs())
+    reputation, amount, count = mergeServerSums(server_sums, weight)
+    return server_sums, reputation, amount, count
+
+
+def loadReputationJobs():
+    '''
+    Load the amount of worker processes from argument --rjobs , at least 1.
+    '''
+    try:
+        jobs = int(args.rjobs)
+    except:
+        print('Invalid argument --rjobs . It should be an integer.')
+        sys.exit(1)
+    if jobs < 1:
+        print('Invalid argument --rjobs . It should be at least 1.')
+        sys.exit(1)
+    return jobs
+
+
+def logReputationChanges(changes):
+    '''
+    Append changes of the submit store to reputation_changes.log , one json per line.
+    They will be applied to the reputation base by generateReputationBase().
+    add / revoke : {'op': 'add' or 'revoke', 'server': server_uuid, 'submit': submit_uuid, 'seq': number,
+                    'player_uuid': player_uuid, 'points': points}
+    commit : {'op': 'commit', 'server': server_uuid, 'seq': number} , the index with changes up to seq was saved
+    weight : {'op': 'weight', 'server': server_uuid}
+    Changes are numbered per server by the index and logged before the index is saved.
+    If the index is not saved , the same numbers are logged again for what is saved next ,
+    so for each number only the last change logged counts , and only after it is committed.
+    '''
+    if len(changes) == 0:
+        return 0
+    data = ''.join(json.dumps(items) + '\n' for items in changes)
+    with reputation_log_lock:
+        with open('reputation_changes.log', 'a', encoding='utf-8') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+    return 0
+
+
+def readReputationChanges(offset):
+    '''
+    Read the changes logged after offset.
+    Return (changes, size of the log)
+    '''
+    if not os.path.exists('reputation_changes.log'):
+        return [], 0
+    with open('reputation_changes.log', 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        if offset > size:  # the log was cleared after the state was saved
+            offset = 0
+        f.seek(offset)
+        data = f.read()
+    changes = []
+    for line in data.decode('utf-8').splitlines():
+        if line.strip() != '':
+            changes.append(json.loads(line))
+    return changes, size
+
+
+def loadReputationState():
+    '''
+    Load the state of the reputation base from reputation_state.json , return None if there is no valid state.
+    weights : server uuid >> weight used for the points of this server
+    servers : server uuid >> player uuid >> [sum of points before being weighted , amount of submits]
+    seq : server uuid >> number of the last change applied , see logReputationChanges()
+    pending : changes logged but not committed yet , they are applied once their index is saved
+    log_size : how many bytes of reputation_changes.log have been applied
+    '''
+    if not os.path.exists('reputation.json'):
+        return None
+    try:
+        with open('reputation_state.json', 'r', encoding='utf-8') as f:
+            state = json.loads(f.read())
+    except:
+        return None
+    if state.get('version') != 4:
+        return None
+    return state
+
+
+def reputationUpToDate(state, weight):
+    '''
+    Return True if nothing was logged , no weight changed and no server was removed since the state was saved.
+    '''
+    log_size = 0
+    if os.path.exists('reputation_changes.log'):
+        log_size = os.path.getsize('reputation_changes.log')
+    if log_size != state['log_size']:
+        return False
+    trusted = set(os.listdir('TrustPlayersList'))
+    for server in state['servers']:
+        if server not in trusted or weight.get(server) is None:
+            return False
+        if float(weight.get(server)) != state['weights'][server]:
+            return False
+    return True
+
+
+def saveReputationState(state):
+    '''
+    Save the state of the reputation base , and clear the change log that has been applied.
+    The state is saved before the log is removed , if it stops in between ,
+    the old log is read again and every change in it is skipped by its number.
+    '''
+    with reputation_log_lock:
+        # nothing new was logged after the state was saved , the log can be cleared
+        if os.path.exists('reputation_changes.log') and os.path.getsize('reputation_changes.log') == state['log_size']:
+            state['log_size'] = 0
+            atomicWrite('reputation_state.json', json.dumps(state))
+            os.remove('reputation_changes.log')
+            return 0
+    atomicWrite('reputation_state.json', json.dumps(state))
+    return 0
+
+
+def addServerSum(sums, player_uuid, points, amount):
+    '''
+    Add the points of one submit to the sums of its server.
+    amount is 1 to add a submit , -1 to remove it.
+    '''
+    if player_uuid is None:  # content could not be parsed
+        return 0
+    if player_uuid not in sums:
+        sums[player_uuid] = [0.0, 0]
+    record = sums[player_uuid]
+    if amount > 0:
+        record[0] = record[0] + points
+    else:
+        record[0] = record[0] - points
+    record[1] += amount
+    if record[1] <= 0:
+        del sums[player_uuid]
+    return 0
+
+
+def playerReputation(state, server_list, player_uuid):
+    '''
+    Merge the sums of one player from every server , the same way as mergeServerSums().
+    server_list : sorted server uuids of the state
+    Return None if no server has a submit about this player.
+    '''
+    reputation = None
+    for server in server_list:
+        record = state['servers'][server].get(player_uuid)
+        if record is None:
+            continue
+        player_point = record[0] * state['weights'][server]
+        if reputation is None:
+            reputation = player_point
+        else:
+            reputation = reputation + player_point
+    return reputation
+
+
+def applyReputationChanges(state, weight, reputation, delta):
+    '''
+    Apply the logged changes to the state and the reputation base.
+    The sums of every server are saved before being weighted ,
+    so a weight change only recomputes the players of that server , no submit is read.
+    Servers removed from TrustPlayersList are removed from the state.
+    delta : the players changed are saved here , player uuid >> [old reputation , new reputation]
+    Return the amount of changes applied.
+    '''
+    changes, log_size = readReputationChanges(state['log_size'])
+    changed_player = set()  # players whose reputation should be recomputed
+    count = 0
+
+    # servers that are not trusted anymore
+    trusted = set(os.listdir('TrustPlayersList'))
+    for server in list(state['servers']):
+        if server not in trusted:
+            changed_player.update(state['servers'][server])
+            del state['servers'][server]
+            del state['weights'][server]
+            state['seq'].pop(server, None)
+            count += 1
+
+    # for each number the last change logged counts , see logReputationChanges()
+    logged = {}  # server uuid >> seq >> change
+    committed = {}  # server uuid >> seq of the last index saved
+    for items in state['pending'] + changes:
+        server = items['server']
+        if server not in trusted or items['op'] == 'weight':  # weights are compared below
+            continue
+        if items['op'] == 'commit':
+            committed[server] = max(committed.get(server, 0), items['seq'])
+        else:
+            logged.setdefault(server, {})[items['seq']] = items
+
+    pending = []
+    for server in set(logged) | set(committed):
+        applied = state['seq'].get(server, 0)
+        commit = max(committed.get(server, 0), applied)
+        if server not in state['servers']:  # a new server
+            checkServerWeight(weight, [server])
+            state['servers'][server] = {}
+            state['weights'][server] = float(weight.get(server))
+        for seq in sorted(logged.get(server, {})):
+            items = logged[server][seq]
+            if seq <= applied:  # applied before , the log was read again
+                continue
+            if seq > commit:  # not in the index yet
+                pending.append(items)
+                continue
+            if items['op'] == 'add':
+                addServerSum(state['servers'][server], items['player_uuid'], items['points'], 1)
             else:
-                sump = reputation[player_uuid]
-                sump = sump + player_point
-                reputation[player_uuid] = sump
-            # print('  >>From submit : '+submit)
-            # print("Solving player: " + player_uuid)
-            # print("With points: " + str(player_point_ori) + ", Magnification: " + str(pownum) + "x, Total points: " + str(sump))
-            # print("\n")
+                addServerSum(state['servers'][server], items['player_uuid'], items['points'], -1)
+            if items['player_uuid'] is not None:
+                changed_player.add(items['player_uuid'])
+            count += 1
+        state['seq'][server] = commit
+    state['pending'] = pending
+
+    # weights changed by --setweight or by editing weight.json
+    checkServerWeight(weight, state['servers'])
+    for server in state['servers']:
+        pownum = float(weight.get(server))
+        if pownum != state['weights'][server]:
+            state['weights'][server] = pownum
+            changed_player.update(state['servers'][server])
             count += 1
-            progressController(count/submit_amount * 100)
+
+    server_list = sorted(state['servers'])
+    for player_uuid in changed_player:
+        player_point = playerReputation(state, server_list, player_uuid)
+        if player_point != reputation.get(player_uuid):
+            delta[player_uuid] = [reputation.get(player_uuid), player_point]
+        if player_point is None:
+            reputation.pop(player_uuid, None)
+        else:
+            reputation[player_uuid] = player_point
+
+    state['log_size'] = log_size
+    return count
+
+
+def checkReputation(reputation, weight):
+    '''
+    Compare the reputation base with a full recompute from all submits.
+    '''
+    print('\nChecking the reputation base with a full recompute...')
+    server_sums, full, amount, count = fullReputation(weight)
+    wrong = []
+    for player_uuid in set(full) | set(reputation):
+        if player_uuid not in full or player_uuid not in reputation:
+            wrong.append(player_uuid)
+        elif abs(full[player_uuid] - reputation[player_uuid]) > 1e-9 * max(1.0, abs(full[player_uuid])):
+            wrong.append(player_uuid)
+    if len(wrong) == 0:
+        print('\nConsistency check passed.')
+        return True
+    print('\nConsistency check failed , ' + str(len(wrong)) + ' player<s> differ :')
+    for items in wrong[:20]:
+        print('  ' + items + ' : ' + str(reputation.get(items)) + ' != ' + str(full.get(items)))
+    print('Use --update --rebuild to recompute the reputation base.')
+    return False
+
+
+def generateReputationBase():
+    '''
+    Generate local reputation base
+    Only the changes logged by the pull stage or --setweight since the last run are applied to the saved state.
+    With --rebuild , it is recomputed from all submits.
+    With --check , the result is compared with a full recompute.
+    With --vectorized , full recomputes are done with pandas.
+    With --rjobs N , full recomputes are done in N worker processes.
+    '''
+    # load weight file
+    with open("weight.json", 'r') as f:
+        weight = json.loads(f.read())
+
+    state = loadReputationState()
+    delta = {}  # players changed , for generateBanList()
+    full = False  # the ban list should be checked with a full scan
+    reputation = None
+    if not args.rebuild and state is not None:
+        if reputationUpToDate(state, weight):
+            # nothing to apply , the files are not written again
+            print("Solved 0 change<s> into local reputation base.")
+            if args.check:
+                with open("reputation.json", 'r', encoding='utf-8') as f:
+                    checkReputation(json.loads(f.read()), weight)
+            return 0
+        try:
+            with open("reputation.json", 'r', encoding='utf-8') as f:
+                reputation = json.loads(f.read())
+        except ValueError:  # broken , it is recomputed
+            reputation = None
+    if reputation is None:
+        full = True
+        server_sums, reputation, amount, count = fullReputation(weight)
+        # changes logged so far are counted up to log_seq of each index ,
+        # the ones after it were never saved , they are logged again when they are
+        log_size = 0
+        if os.path.exists('reputation_changes.log'):
+            log_size = os.path.getsize('reputation_changes.log')
+        state = {'version': 4, 'weights': {}, 'servers': {}, 'seq': {}, 'pending': [], 'log_size': log_size}
+        for server in server_sums:
+            partial, part_amount, part_count, log_seq = server_sums[server]
+            state['weights'][server] = float(weight.get(server))
+            state['servers'][server] = {}
+            for player_uuid in partial:
+                state['servers'][server][player_uuid] = [partial[player_uuid], part_amount[player_uuid]]
+            state['seq'][server] = log_seq
+        print("\nSolved " + str(count) + " submit<s> into local reputation base.")
+    else:
+        count = applyReputationChanges(state, weight, reputation, delta)
+        print("Solved " + str(count) + " change<s> into local reputation base.")
 
     with open("reputation.json", "w+") as fp:
         fp.write(json.dumps(reputation, indent=4))
+    saveReputationIndex(reputation)
+    saveReputationDelta(delta, full)
+    saveReputationState(state)
 
-    end = time.time()
-    print("\nSolved " + str(count) + " submit<s> into local reputation base.")
+    if args.check:
+        checkReputation(reputation, weight)
     return 0
 
 
-def backup(banlistIsNew: bool):
+def loadReputationDelta():
     '''
-    Backup old ban list to folder ./backup
-    If banlist is new created , it will not be backup
-    If old ban list is empty , it will not be backup neither
+    Load reputation_delta.json , return None if there is no valid delta.
+    players : player uuid >> [old reputation , new reputation] , None if the player has no reputation
+    full : the reputation base was rebuilt , the ban list should be checked with a full scan
+    threshold : min_point_toban used by the last ban list , None if it was not generated yet
     '''
-    if banlistIsNew == True:
+    if not tryJsonValid('reputation_delta.json'):
+        return None
+    with open('reputation_delta.json', 'r', encoding='utf-8') as f:
+        return json.loads(f.read())
+
+
+def saveReputationDelta(delta, full=False, threshold=None):
+    '''
+    Merge the players changed into reputation_delta.json , it is consumed by generateBanList()
+    Changes of a player in several runs are merged into one , from the oldest to the newest reputation.
+    '''
+    saved = loadReputationDelta()
+    if saved is None:
+        saved = {'full': False, 'threshold': threshold, 'players': {}}
+    if threshold is not None:
+        saved['threshold'] = threshold
+    saved['full'] = saved['full'] or full
+    if saved['full']:
+        saved['players'] = {}  # a full scan will check everyone
+    else:
+        for player_uuid in delta:
+            old = delta[player_uuid][0]
+            if player_uuid in saved['players']:
+                old = saved['players'][player_uuid][0]
+            if old == delta[player_uuid][1]:  # changed back
+                saved['players'].pop(player_uuid, None)
+            else:
+                saved['players'][player_uuid] = [old, delta[player_uuid][1]]
+    atomicWrite('reputation_delta.json', json.dumps(saved))
+    return 0
+
+
+def saveReputationIndex(reputation):
+    '''
+    Save the players sorted by reputation , next to reputation.json
+    reputation_scores.bin : the sorted reputation , as 8 bytes floats
+    reputation_players.txt : player uuids in the same order , one per line
+    reputation_index.json : the size and modify time of reputation.json , to find out if the index is out of date.
+    '''
+    players = sorted(reputation, key=reputation.get)
+    scores = array('d', [reputation[player_uuid] for player_uuid in players])
+    stat = os.stat('reputation.json')
+    atomicWrite('reputation_scores.bin', scores.tobytes())
+    atomicWrite('reputation_players.txt', ''.join(player_uuid + '\n' for player_uuid in players))
+    # written at last , the index is only valid when all files are written
+    atomicWrite('reputation_index.json', json.dumps(
+        {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'count': len(players)}))
+    return 0
+
+
+def checkReputationIndex():
+    '''
+    Rebuild the index from reputation.json if it is missing or out of date.
+    '''
+    stat = os.stat('reputation.json')
+    if tryJsonValid('reputation_index.json') and os.path.exists('reputation_scores.bin') \
+            and os.path.exists('reputation_players.txt'):
+        with open('reputation_index.json', 'r', encoding='utf-8') as f:
+            index = json.loads(f.read())
+        if index.get('mtime') == stat.st_mtime_ns and index.get('size') == stat.st_size \
+                and os.path.getsize('reputation_scores.bin') == index['count'] * 8:
+            return 0
+    with open('reputation.json', 'r', encoding='utf-8') as f:
+        reputation = json.loads(f.read())
+    saveReputationIndex(reputation)
+    return 0
+
+
+def banCandidates(threshold):
+    '''
+    Get the players whose reputation is not more than threshold , from the lowest.
+    The sorted reputation is searched with bisect in place , only the players found are read.
+    Return (player uuids , reputation)
+    '''
+    checkReputationIndex()
+    if os.path.getsize('reputation_scores.bin') == 0:
+        return [], []
+    with open('reputation_scores.bin', 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        scores = memoryview(mapped).cast('d')
+        end = bisect.bisect_right(scores, threshold)
+        found_scores = scores[:end].tolist()
+        scores.release()
+    players = []
+    with open('reputation_players.txt', 'r', encoding='utf-8') as f:
+        for line in f:
+            if len(players) == end:
+                break
+            players.append(line.rstrip('\n'))
+    return players, found_scores
+
+
+def listCandidates():
+    '''
+    List the players that would be banned at a threshold : -t [Threshold]
+    The default threshold is min_point_toban in mprdb.ini
+    Players already in the ban list are listed too.
+    '''
+    if not tryJsonValid('reputation.json'):
+        print('Local reputation base not found , use --update first.')
         return 0
+    if args.threshold == 'None':
+        conf.read('mprdb.ini')
+        threshold = conf.get('mprdb', 'min_point_toban')
+    else:
+        threshold = args.threshold
+    try:
+        threshold = float(threshold)
+    except ValueError:
+        print('Invalid threshold : ' + threshold)
+        sys.exit(1)
 
+    start_time = time.time()
+    players, scores = banCandidates(threshold)
+    used = time.time() - start_time
+    for player_uuid, score in zip(players, scores):
+        print('  ' + player_uuid + '  ' + str(score) + '  ' + playersMapGet(player_uuid))
+    print(str(len(players)) + ' player<s> would be banned at ' + str(threshold) +
+          ' . ({:.3f}s)'.format(used))
+    return 0
+
+
+def loadBackupConfig():
+    '''
+    Load the backup policy from mprdb.ini
+    backup_snapshot_every : a full snapshot is saved every N records , the others only save changes , default to 10
+    backup_keep_days : records older than N days are removed , 0 to keep all , default to 90
+    '''
+    conf.read('mprdb.ini')
+    try:
+        snapshot_every = int(conf.get('mprdb', 'backup_snapshot_every', fallback='10'))
+        keep_days = float(conf.get('mprdb', 'backup_keep_days', fallback='90'))
+    except ValueError:
+        snapshot_every = keep_days = -1
+    if snapshot_every < 1 or keep_days < 0:
+        print('Invalid backup_snapshot_every or backup_keep_days in mprdb.ini .')
+        sys.exit(1)
+    return snapshot_every, keep_days
+
+
+def loadBackupHistory():
+    '''
+    Load the index of backup history from backup/history/history.json
+    entries : records from the oldest , {'time' , 'type' : snapshot or delta , 'file' , 'saved' : unix time}
+    next : the number of the next record file
+    '''
+    if tryJsonValid('backup/history/history.json'):
+        with open('backup/history/history.json', 'r', encoding='utf-8') as f:
+            return json.loads(f.read())
+    return {'next': 0, 'entries': []}
+
+
+def writeBackupEntry(history, timepoint, entry_type, data):
+    '''
+    Save a record to backup history , compressed with gzip.
+    snapshot data : the whole ban list
+    delta data : {'add' : entries added or changed , 'remove' : uuids removed}
+    '''
+    if not os.path.exists('backup/history'):
+        os.makedirs('backup/history')
+    filename = '{:06d}-{}.{}.json.gz'.format(history['next'], timepoint, entry_type)
+    atomicWrite('backup/history/' + filename,
+                gzip.compress(json.dumps(data, ensure_ascii=False).encode('utf-8')))
+    history['next'] += 1
+    history['entries'].append({'time': timepoint, 'type': entry_type, 'file': filename, 'saved': time.time()})
+    return 0
+
+
+def readBackupEntry(entry):
+    with open('backup/history/' + entry['file'], 'rb') as f:
+        return json.loads(gzip.decompress(f.read()).decode('utf-8'))
+
+
+def rebuildBackup(history, position):
+    '''
+    Rebuild the ban list of a record , from the snapshot before it and the deltas between.
+    Only these records are decompressed.
+    Return a dict : player uuid >> ban entry
+    '''
+    start = position
+    while history['entries'][start]['type'] != 'snapshot':
+        start -= 1
+    entries = {}
+    for entry in readBackupEntry(history['entries'][start]):
+        entries[entry['uuid']] = entry
+    for index in range(start + 1, position + 1):
+        delta = readBackupEntry(history['entries'][index])
+        for player_uuid in delta['remove']:
+            entries.pop(player_uuid, None)
+        for entry in delta['add']:
+            entries.pop(entry['uuid'], None)
+            entries[entry['uuid']] = entry
+    return entries
+
+
+def pruneBackupHistory(history, keep_days):
+    '''
+    Remove the records older than keep_days.
+    A snapshot and its deltas are only removed together , when a newer snapshot is old enough too ,
+    so every record kept can still be rebuilt.
+    '''
+    if keep_days == 0:
+        return 0
+    cutoff = time.time() - keep_days * 86400
+    snapshots = [index for index in range(len(history['entries']))
+                 if history['entries'][index]['type'] == 'snapshot']
+    # the newest snapshot older than cutoff , the records before it are not needed
+    remove_before = 0
+    for index in snapshots:
+        if history['entries'][index]['saved'] < cutoff:
+            remove_before = index
+    for entry in history['entries'][:remove_before]:
+        try:
+            os.remove('backup/history/' + entry['file'])
+        except OSError:
+            pass
+    history['entries'] = history['entries'][remove_before:]
+    return 0
+
+
+def recordBanList(history, timepoint, entries, snapshot_every):
+    '''
+    Save a record of a ban list to backup history.
+    A full snapshot is saved every snapshot_every records , the others only save the changes since the last record.
+    entries : player uuid >> ban entry
+    '''
+    since_snapshot = 0
+    for entry in reversed(history['entries']):
+        if entry['type'] == 'snapshot':
+            break
+        since_snapshot += 1
+    if len(history['entries']) == 0 or since_snapshot + 1 >= snapshot_every:
+        writeBackupEntry(history, timepoint, 'snapshot', list(entries.values()))
+        return 0
+    old = rebuildBackup(history, len(history['entries']) - 1)
+    delta = {'add': [], 'remove': []}
+    for player_uuid in old:
+        if player_uuid not in entries:
+            delta['remove'].append(player_uuid)
+    for player_uuid in entries:
+        if old.get(player_uuid) != entries[player_uuid]:
+            delta['add'].append(entries[player_uuid])
+    writeBackupEntry(history, timepoint, 'delta', delta)
+    return 0
+
+
+def backup(banlist_path, banlistIsNew: bool, banlist_size, banlist):
+    '''
+    Record the new ban list into the backup history in ./backup/history
+    A full snapshot is saved every backup_snapshot_every records , the others only save the changes
+    since the last record , including changes made by the minecraft server.
+    The first record also saves the old ban list , unless it is new created or empty ,
+    at the time the file was last modified , so it can be restored by time.
+    Records older than backup_keep_days are removed.
+    '''
+    snapshot_every, keep_days = loadBackupConfig()
+    history = loadBackupHistory()
     timepoint = str(time.strftime("%Y%m%d-%H%M%S", time.localtime()))
-    if not os.path.exists("backup"):
-        os.makedirs("backup")
 
-    with open('banned-players.json', 'r') as f:
-        banned_players_list = json.loads(f.read())
-    if len(banned_players_list) == 0:
-        print('\nThe old ban list is empty , it will not be backup')
+    if len(history['entries']) == 0 and not banlistIsNew and banlist_size > 0:
+        # the ban list before the first record
+        modified = str(time.strftime("%Y%m%d-%H%M%S", time.localtime(os.path.getmtime(banlist_path))))
+        writeBackupEntry(history, min(modified, timepoint), 'snapshot',
+                         list(BanList(banlist_path).entries.values()))
+
+    recordBanList(history, timepoint, banlist.entries, snapshot_every)
+    pruneBackupHistory(history, keep_days)
+    atomicWrite('backup/history/history.json', json.dumps(history, indent=4))
+    return 0
+
+
+def listBackupHistory(history):
+    '''
+    Print the records of backup history , they can be restored with --restore #N
+    '''
+    if len(history['entries']) == 0:
+        print('No backup found.')
         return 0
+    for entry in history['entries']:
+        print('  #' + str(int(entry['file'][:6])) + '  ' + entry['time'] + '  ' + entry['type'])
+    return 0
+
 
-    filename = "banned-players-backup-" + timepoint + ".json"
-    os.rename('banned-players.json', filename)
-    shutil.copy(filename, "backup/")
-    os.rename(filename, 'banned-players.json')
+def restoreBanList(timepoint):
+    '''
+    Restore the ban list recorded at a time : --restore [Time]
+    [Time] : like 20230102-030405 , or a part of it like 20230102 , the last record not later than it is used ,
+             or #N for the record numbered N , list to print the records.
+    The current ban list is recorded before it is replaced , including changes made by the minecraft server ,
+    so a restore can be undone by restoring that record.
+    '''
+    history = loadBackupHistory()
+    if timepoint == 'list':
+        return listBackupHistory(history)
+    position = None
+    if timepoint.startswith('#'):
+        for index in range(len(history['entries'])):
+            if timepoint[1:].isdigit() and int(history['entries'][index]['file'][:6]) == int(timepoint[1:]):
+                position = index
+        if position is None:
+            print('No backup numbered ' + timepoint + ' , use --restore list to list the records.')
+            return 0
+    else:
+        digits = ''.join(char for char in timepoint if char.isdigit())
+        if len(digits) == 0 or len(digits) > 14:
+            print('Invalid time : ' + timepoint)
+            return 0
+        digits = digits.ljust(14, '9')  # 20230102 means the end of that day
+        for index in range(len(history['entries'])):
+            if history['entries'][index]['time'].replace('-', '') <= digits:
+                position = index
+        if position is None:
+            print('No backup found before ' + timepoint)
+            return 0
+
+    entries = rebuildBackup(history, position)
+    print('Restoring the ban list recorded at ' + history['entries'][position]['time'] +
+          ' (#' + str(int(history['entries'][position]['file'][:6])) + ') , ' +
+          str(len(entries)) + ' player<s>.')
+    conf.read('mprdb.ini')
+    banlist_path = args.name if args.name != 'None' else conf.get('mprdb', 'banlist_path')
+    banlist = BanList(banlist_path)
+
+    # the list on disk may have been changed since the last record , record it before it is replaced
+    if os.path.exists(banlist_path) and rebuildBackup(history, len(history['entries']) - 1) != banlist.entries:
+        snapshot_every, keep_days = loadBackupConfig()
+        current = str(time.strftime("%Y%m%d-%H%M%S", time.localtime()))
+        recordBanList(history, current, banlist.entries, snapshot_every)
+        atomicWrite('backup/history/history.json', json.dumps(history, indent=4))
+        print('The current ban list is recorded as #' + str(history['next'] - 1) + ' .')
+
+    banlist_size = len(banlist)
+    for player_uuid in [entry['uuid'] for entry in banlist]:
+        if player_uuid not in entries:
+            banlist.remove(player_uuid)
+    for player_uuid in entries:
+        if banlist.get(player_uuid) != entries[player_uuid]:
+            banlist.remove(player_uuid)
+            banlist.add(entries[player_uuid])
+    if not banlist.changed():
+        print('Nothing changed.')
+        return 0
+    backup(banlist_path, not os.path.exists(banlist_path), banlist_size, banlist)
+    newList(banlist)
     return 0
 
 
+def loadPlayersMap():
+    '''
+    Load players_map.json and replay players_map.journal , only once in a process.
+    Return the map : player uuid >> entry
+    entry : [player name , fetched at] , or [None , fetched at , amount of misses] if mojang does not know the player
+    A name saved by an older version has no fetched time , it is treated as stale.
+    '''
+    global players_map, players_map_journal_size
+    with players_map_lock:
+        if players_map is not None:
+            return players_map
+        mapping = {}
+        if tryJsonValid('players_map.json'):
+            with open('players_map.json', 'r', encoding='utf-8') as f:
+                mapping = json.loads(f.read())
+            for player_uuid in mapping:
+                if isinstance(mapping[player_uuid], str):
+                    mapping[player_uuid] = [mapping[player_uuid], 0]
+        journal_size = 0
+        if os.path.exists('players_map.journal'):
+            good_size = 0  # bytes of complete entries
+            with open('players_map.journal', 'rb') as f:
+                for line in f:
+                    try:
+                        items = json.loads(line.decode('utf-8'))
+                    except ValueError:  # the last line could be partially written
+                        break
+                    if isinstance(items[1], str):
+                        items[1] = [items[1], 0]
+                    mapping[items[0]] = items[1]
+                    journal_size += 1
+                    good_size += len(line)
+            if good_size != os.path.getsize('players_map.journal'):
+                # drop the broken tail , or the next entry would be appended to it
+                with open('players_map.journal', 'r+b') as f:
+                    f.truncate(good_size)
+        players_map = mapping
+        players_map_journal_size = journal_size
+    return players_map
+
+
 def playersMapGet(player_uuid):  # uuid to name
     '''
-    Get player name from local players_map.json , to increase of efficiency
+    Get player name from local players map , to increase of efficiency
+    Return '-1' if the player is unknown or not found.
     '''
-    players_map = {}
-    with open('players_map.json', 'r') as f:
-        players_map = json.loads(f.read())
-    player_name = players_map.get(player_uuid, '-1')
-    return player_name
+    entry = loadPlayersMap().get(player_uuid)
+    if entry is None or entry[0] is None:
+        return '-1'
+    return entry[0]
+
+
+def playersMapStatus(player_uuid, now=None):
+    '''
+    Check whether a player should be searched from mojang.
+    Return 'unknown' , 'fresh' , 'stale' (name is too old) , 'miss' (not found recently) or 'expired' (not found , long ago)
+    '''
+    if now is None:
+        now = time.time()
+    entry = loadPlayersMap().get(player_uuid)
+    if entry is None:
+        return 'unknown'
+    if entry[0] is None:
+        ttl = min(PLAYER_MISS_TTL * 2 ** (entry[2] - 1), PLAYER_MISS_TTL_MAX)
+        if now - entry[1] < ttl:
+            return 'miss'
+        return 'expired'
+    if now - entry[1] < PLAYER_NAME_TTL:
+        return 'fresh'
+    return 'stale'
+
+
+def playersMapPut(player_uuid, entry):
+    '''
+    Save an entry to the players map.
+    It is written to players_map.journal in batches , call playersMapFlush() before exit.
+    '''
+    mapping = loadPlayersMap()
+    with players_map_lock:
+        mapping[player_uuid] = entry
+        players_map_pending.append([player_uuid, entry])
+        full = len(players_map_pending) >= PLAYERS_MAP_BATCH
+    if full:
+        playersMapFlush()
+    return 0
 
 
 def playersMapSave(player_uuid, player_name):  # save uuid and name to file
     '''
-    Save the player that isnt in the players_map.json , to increase of efficiency
+    Save the player that isnt in the players map , to increase of efficiency
+    '''
+    return playersMapPut(player_uuid, [player_name, time.time()])
+
+
+def playersMapMiss(player_uuid):
+    '''
+    Save a player that mojang does not know , it will not be searched again until its backoff passed.
+    A player found before keeps the old name.
+    '''
+    entry = loadPlayersMap().get(player_uuid)
+    if entry is not None and entry[0] is not None:
+        return playersMapPut(player_uuid, [entry[0], time.time()])
+    misses = 1
+    if entry is not None:
+        misses = entry[2] + 1
+    return playersMapPut(player_uuid, [None, time.time(), misses])
+
+
+def playersMapFlush():
+    '''
+    Append the new entries to players_map.journal and fsync it.
+    When the journal is too long , it is compacted into players_map.json.
+    '''
+    global players_map_journal_size
+    with players_map_lock:
+        if len(players_map_pending) > 0:
+            with open('players_map.journal', 'a', encoding='utf-8') as f:
+                for items in players_map_pending:
+                    f.write(json.dumps(items, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            players_map_journal_size += len(players_map_pending)
+            players_map_pending.clear()
+        compact = players_map_journal_size >= PLAYERS_MAP_COMPACT
+    if compact:
+        playersMapCompact()
+    return 0
+
+
+def playersMapCompact():
+    '''
+    Write the whole players map to players_map.json , then remove players_map.journal.
     '''
-    players_map = {}
-    with open('players_map.json', 'r') as f:
-        players_map = json.loads(f.read())
-    players_map[player_uuid] = player_name
-    with open('players_map.json', 'w+') as d:
-        d.write(json.dumps(players_map, indent=4, ensure_ascii=False))
+    global players_map_journal_size
+    mapping = loadPlayersMap()
+    with players_map_lock:
+        atomicWrite('players_map.json', json.dumps(mapping, indent=4, ensure_ascii=False))
+        # the entries still pending are in players_map.json now
+        players_map_pending.clear()
+        if os.path.exists('players_map.journal'):
+            os.remove('players_map.journal')
+        players_map_journal_size = 0
     return 0
 
 
 def newList(banlist):
-    # create new ban list
+    '''
+    Save the new ban list to the server folder , atomically.
+    If the server folder is not available , it is saved as banned-players.json here.
+    '''
+    try:
+        banlist.save()
+        print('\nSaving new ban list to server folder...')
+    except OSError:
+        print('\nUnable to save file to server folder , saved as banned-players.json')
+        banlist.save('banned-players.json')
+    return 0
+
+
+def userCachePath():
+    '''
+    Get the path of usercache.json of the minecraft server.
+    It can be set with usercache_path in mprdb.ini , default to the folder of banlist_path.
+    '''
     conf.read('mprdb.ini')
-    file_server_banlist = conf.get('mprdb', 'banlist_path')
+    path = conf.get('mprdb', 'usercache_path', fallback='')
+    if path != '':
+        return path
+    banlist_path = conf.get('mprdb', 'banlist_path', fallback='')
+    return os.path.join(os.path.dirname(banlist_path), 'usercache.json')
+
 
-    with open("banned-players.json", "w+", encoding='utf-8') as fp:
-        fp.write(json.dumps(banlist, indent=4, ensure_ascii=False))
+def syncUserCache():
+    '''
+    Import the names in usercache.json of the minecraft server into the players map.
+    It is only read again when it changed since the last sync , see usercache_meta.json
+    Return the amount of names imported.
+    '''
+    path = userCachePath()
     try:
-        shutil.copy('banned-players.json', file_server_banlist)
-        print('\nCopying new ban list to server folder...')
-    except:
-        print('\nUnable to copy file to server folder.')
+        stat = os.stat(path)
+    except OSError:
+        return 0
+    meta = {}
+    if tryJsonValid('usercache_meta.json'):
+        with open('usercache_meta.json', 'r', encoding='utf-8') as f:
+            meta = json.loads(f.read())
+    if meta.get('path') == os.path.abspath(path) and meta.get('mtime') == stat.st_mtime_ns \
+            and meta.get('size') == stat.st_size:
+        return 0
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            usercache = json.loads(f.read())
+    except (OSError, ValueError):
+        print('Unable to read usercache.json : ' + path)
+        return 0
+
+    count = 0
+    for items in usercache:
+        try:
+            player_uuid = items['uuid']
+            player_name = items['name']
+        except (KeyError, TypeError):
+            continue
+        # new player , renamed , or the name is too old
+        if playersMapGet(player_uuid) != player_name or playersMapStatus(player_uuid) != 'fresh':
+            playersMapSave(player_uuid, player_name)
+            count += 1
+    playersMapFlush()
+    atomicWrite('usercache_meta.json', json.dumps(
+        {'path': os.path.abspath(path), 'mtime': stat.st_mtime_ns, 'size': stat.st_size}))
+    return count
+
+
+def loadMojangLimit():
+    '''
+    Load the rate limit of mojang requests from mprdb.ini
+    mojang_rate : requests per second , default to 1
+    mojang_burst : requests that can be sent at once , default to 10
+    mojang_workers : requests at the same time , default to 8
+    '''
+    conf.read('mprdb.ini')
+    try:
+        rate = float(conf.get('mprdb', 'mojang_rate', fallback='1'))
+        burst = float(conf.get('mprdb', 'mojang_burst', fallback='10'))
+        workers = int(conf.get('mprdb', 'mojang_workers', fallback='8'))
+    except ValueError:
+        print('Invalid mojang_rate , mojang_burst or mojang_workers in mprdb.ini .')
+        sys.exit(1)
+    if rate <= 0 or burst < 1 or workers < 1:
+        print('Invalid mojang_rate , mojang_burst or mojang_workers in mprdb.ini .')
+        sys.exit(1)
+    return rate, burst, workers
+
+
+def mojangTakeToken(rate, burst, answered=None):
+    '''
+    Wait until a mojang request is allowed by the token bucket.
+    answered : an event set when the name was found by another provider ,
+               then no token is taken and False is returned
+    '''
+    while True:
+        if answered is not None and answered.is_set():
+            return False
+        with mojang_bucket_lock:
+            now = time.monotonic()
+            if mojang_bucket['tokens'] is None:
+                mojang_bucket['tokens'] = burst
+                mojang_bucket['time'] = now
+            if now < mojang_bucket['pause_until']:  # mojang answered 429
+                wait = mojang_bucket['pause_until'] - now
+            else:
+                mojang_bucket['tokens'] = min(
+                    burst, mojang_bucket['tokens'] + (now - mojang_bucket['time']) * rate)
+                mojang_bucket['time'] = now
+                if mojang_bucket['tokens'] >= 1:
+                    mojang_bucket['tokens'] -= 1
+                    return True
+                wait = (1 - mojang_bucket['tokens']) / rate
+        searchSleep(wait, answered)
+
+
+def mojangPause(seconds):
+    '''
+    Stop all mojang requests for some seconds , and empty the token bucket.
+    '''
+    with mojang_bucket_lock:
+        mojang_bucket['pause_until'] = max(mojang_bucket['pause_until'], time.monotonic() + seconds)
+        mojang_bucket['tokens'] = 0
     return 0
 
 
-def searchOnline(player_uuid, i, changed, banlist, banlistIsNew):  # return (name or code,i)
+def searchSleep(seconds, answered=None):
+    '''
+    Sleep between retries of a search , return True if the name was found by another provider meanwhile.
+    '''
+    if answered is None:
+        time.sleep(seconds)
+        return False
+    return answered.wait(seconds)
+
+
+def recordLatency(provider, seconds):
+    '''
+    Record the latency of one request to a provider , the wait for mojang_rate is not counted.
+    '''
+    with provider_latency_lock:
+        provider_latency[provider].append(seconds)
+    return 0
+
+
+def searchOnline(player_uuid, rate, burst, attempts=5, answered=None):  # return name , '-1' or None
     '''
     player uuid to player name , from mojang
-    if ban list changed and mojang site crashed , return code -2 , and save ban list
-    if ban list not changed and mojang site crashed , return code -3
-    if player not found , return code -1
+    if player not found , return '-1'
+    if mojang site crashed , return None
     if player found , return player name
+    A 429 response pauses every request for Retry-After seconds , then it is tried again.
+    answered : an event set when the name was found by another provider , the search stops and returns None
     '''
     url = "https://sessionserver.mojang.com/session/minecraft/profile/" + \
         player_uuid  # get player name
+    delay = 1
+    for attempt in range(attempts):
+        if not mojangTakeToken(rate, burst, answered):
+            return None
+        start = time.monotonic()
+        try:
+            res = requests.get(url, timeout=5)
+        except:
+            if searchSleep(delay, answered):
+                return None
+            delay *= 2
+            continue
+        recordLatency('mojang', time.monotonic() - start)
+        if res.status_code == 429:
+            try:
+                retry_after = float(res.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                retry_after = delay
+            mojangPause(retry_after)
+            delay *= 2
+            continue
+        if res.status_code == 204 or res.status_code == 404 or res.text == "":
+            return '-1'
+        if res.status_code != 200:
+            if searchSleep(delay, answered):
+                return None
+            delay *= 2
+            continue
+        try:
+            return res.json()["name"]
+        except:
+            return None
+    return None
+
+
+def searchPlayerdb(player_uuid, attempts=3, answered=None):  # return name , '-1' or None
+    '''
+    player uuid to player name , from playerdb.co
+    if player not found , return '-1'
+    if playerdb site crashed , return None
+    answered : an event set when the name was found by another provider , the search stops and returns None
+    '''
+    url = "https://playerdb.co/api/player/minecraft/" + player_uuid
+    delay = 1
+    for attempt in range(attempts):
+        if answered is not None and answered.is_set():
+            return None
+        start = time.monotonic()
+        try:
+            res = requests.get(url, timeout=5)
+            recordLatency('playerdb', time.monotonic() - start)
+            result = res.json()
+        except:
+            if searchSleep(delay, answered):
+                return None
+            delay *= 2
+            continue
+        if result.get("code") == "player.found":
+            return result["data"]["player"]["username"]
+        if res.status_code == 400 or res.status_code == 404:
+            return '-1'
+        if searchSleep(delay, answered):
+            return None
+        delay *= 2
+    return None
+
+
+def providerLatency(provider, percentile):
+    '''
+    Get a percentile (0 to 100) of the recent latency of a provider , return None if there is no record.
+    '''
+    with provider_latency_lock:
+        record = sorted(provider_latency[provider])
+    if len(record) == 0:
+        return None
+    return record[min(len(record) - 1, int(len(record) * percentile / 100))]
+
+
+def providerOrder():
+    '''
+    Return (primary provider , secondary provider) , the one with a lower median latency is primary.
+    mojang is primary until both have records.
+    '''
+    mojang = providerLatency('mojang', 50)
+    playerdb = providerLatency('playerdb', 50)
+    if mojang is not None and playerdb is not None and playerdb < mojang:
+        return 'playerdb', 'mojang'
+    return 'mojang', 'playerdb'
+
+
+def loadResolver():
+    '''
+    Load how player names are searched from mprdb.ini
+    name_resolver : hedged (default) , parallel or mojang
+    hedged : ask the faster provider , ask the other one too if it is slower than usual
+    parallel : ask both providers , take the first name
+    mojang : ask mojang only
+    name_hedge_percentile : in hedged mode , the other provider is asked when the primary is slower than
+                            this percentile of its latency , default to 95
+    '''
+    conf.read('mprdb.ini')
+    mode = conf.get('mprdb', 'name_resolver', fallback='hedged')
     try:
-        res = getData(url)
-    except:
-        if changed:
-            backup(banlistIsNew)
-            newList(banlist)
-            return "-2", i
-        else:
-            return "-3", i
+        percentile = float(conf.get('mprdb', 'name_hedge_percentile', fallback='95'))
+    except ValueError:
+        percentile = -1
+    if mode not in ('hedged', 'parallel', 'mojang') or not 0 < percentile <= 100:
+        print('Invalid name_resolver or name_hedge_percentile in mprdb.ini .')
+        sys.exit(1)
+    return mode, percentile
 
-    if res.text == "":
-        i += 1
-        return '-1', i
+
+def hedgedSearch(player_uuid, rate, burst, mode, percentile, hedger):  # return name , '-1' or None
+    '''
+    player uuid to player name , from mojang and playerdb.co
+    The first name found is taken , '-1' only if no provider found it , None if all providers failed.
+    hedger : thread pool that runs the searches of providers
+    The slower search is stopped once a name is found , before it takes another mojang token.
+    '''
+    answered = threading.Event()
+    search = {'mojang': (searchOnline, player_uuid, rate, burst, 5, answered),
+              'playerdb': (searchPlayerdb, player_uuid, 3, answered)}
+    if mode == 'mojang':
+        return searchOnline(player_uuid, rate, burst)
+
+    primary, secondary = providerOrder()
+    pending = {hedger.submit(*search[primary])}
+    if mode == 'parallel':
+        pending.add(hedger.submit(*search[secondary]))
     else:
-        result = res.json()
-        player_name = result["name"]
-    return player_name, i
+        # wait for the primary as long as it usually takes , at least 0.5 seconds
+        threshold = providerLatency(primary, percentile)
+        if threshold is None:
+            threshold = 1.0
+        done, not_done = wait(pending, timeout=max(threshold, 0.5))
+        if len(done) == 0 or next(iter(done)).result() in ('-1', None):
+            pending.add(hedger.submit(*search[secondary]))
+
+    answers = []
+    while len(pending) > 0:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            answers.append(future.result())
+            if answers[-1] not in ('-1', None):
+                # the slower one stops at its next token or retry , or never starts
+                answered.set()
+                for items in pending:
+                    items.cancel()
+                return answers[-1]
+    if '-1' in answers:
+        return '-1'
+    return None
+
+
+def resolvePlayerNames(player_uuids, show_progress=True, workers=None, settings=None):
+    '''
+    Search the names of players from mojang at the same time , limited by mojang_rate and mojang_burst.
+    The names found and the players not found are saved to the players map.
+    workers : searches at the same time , default to mojang_workers in mprdb.ini
+    settings : (rate , burst , mojang_workers , name_resolver , name_hedge_percentile) ,
+               loaded from mprdb.ini if not given
+    Return (player not found , player failed to search)
+    '''
+    if settings is None:
+        settings = loadMojangLimit() + loadResolver()
+    rate, burst, max_workers, mode, percentile = settings
+    if workers is None:
+        workers = max_workers
+    player_not_found = []
+    player_failed = []
+    done = 0
+    hedger = ThreadPoolExecutor(max_workers=workers * 2)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for player_uuid in player_uuids:
+                futures[executor.submit(hedgedSearch, player_uuid, rate, burst, mode, percentile, hedger)] = player_uuid
+            for future in as_completed(futures):
+                player_uuid = futures[future]
+                player_name = future.result()
+                if player_name is None:
+                    player_failed.append(player_uuid)
+                elif player_name == '-1':
+                    player_not_found.append(player_uuid)
+                    playersMapMiss(player_uuid)
+                else:
+                    playersMapSave(player_uuid, player_name)
+                done += 1
+                if show_progress:
+                    progressController(done/len(futures) * 100)
+    finally:
+        # searches of the slower providers that have not started are dropped
+        hedger.shutdown(cancel_futures=True)
+    playersMapFlush()
+    if show_progress and mode != 'mojang':
+        for provider in ('mojang', 'playerdb'):
+            if providerLatency(provider, 50) is not None:
+                print('\n' + provider + ' latency : p50 {:.2f}s , p95 {:.2f}s'.format(
+                    providerLatency(provider, 50), providerLatency(provider, 95)), end='')
+    return player_not_found, player_failed
+
+
+def refreshPlayerNames(player_uuids):
+    '''
+    Search the stale names again in a background thread , the cached names are used until then.
+    Only one search runs at a time , so names searched later in the foreground still get most of mojang_rate.
+    mprdb.ini is read before the thread starts , the config parser is shared with the main thread.
+    The process waits for it to finish before exit.
+    '''
+    settings = loadMojangLimit() + loadResolver()
+    thread = threading.Thread(target=resolvePlayerNames, args=(player_uuids, False, 1, settings))
+    thread.start()
+    return thread
 
 
 def generateBanList():
@@ -1855,95 +3873,125 @@ def generateBanList():
     '''
     conf.read('mprdb.ini')
     min_point_toban = float(conf.get('mprdb', 'min_point_toban'))
-    file_reputation = "reputation.json"
     file_server_banlist = conf.get('mprdb', 'banlist_path')
     source = conf.get('mprdb', 'ban_source')
     expires = conf.get('mprdb', 'ban_expires')
     reason = conf.get('mprdb', 'ban_reason')
     # Mark submits downloaded by other servers, to prevent from repeating deduction
     reason = '[MPRDB] ' + reason
-    changed = False
     banlistIsNew = False
     player_not_found = []
+    player_failed = []
 
-    with open('players_map.json', 'r') as f:
-        o = json.loads(f.read())
-        ovo(o)
+    # names of players who joined the minecraft server are already known
+    imported = syncUserCache()
+    if imported > 0:
+        print('Imported ' + str(imported) + ' player name<s> from usercache.json')
+    ovo(loadPlayersMap())
 
-    try:
-        shutil.copy(file_server_banlist, os.getcwd())
+    # the ban list is read in place , and replaced atomically when it changed
+    if os.path.exists(file_server_banlist):
         print('Server ban list found, using list: '+file_server_banlist)
-    except:
+    else:
         print('Server ban list not found! Generating...')
         banlistIsNew = True  # if it is new , it will not be backup , because it's empty
-        with open('banned-players.json', 'w+') as f:
-            f.write('[]')
-
-    # load old ban list and local reputation
-    with open(file_reputation, "r", encoding='utf-8') as f:
-        reputation = json.loads(f.read())
-    with open('banned-players.json', "r", encoding='utf-8') as d:
-        banlist = json.loads(d.read())
-
-    already_exist_player = []  # Prevent duplication
-    for items in banlist:  # type(items)=dict
-        already_exist_player.append(items["uuid"])
 
-    banamount = 0  # For progress bar
-    for player_uuid in reputation:
-        if reputation[player_uuid] <= min_point_toban and player_uuid not in already_exist_player:
-            banamount += 1
+    # load old ban list
+    banlist = BanList(file_server_banlist)  # indexed by uuid , to prevent duplication
+    banlist_size = len(banlist)
 
-    i = 0
     # if a player in local reputation with a low point , and he isn't in the old ban list
     # he will be add to the new ban list
-    for player_uuid in reputation:
-        if reputation[player_uuid] <= min_point_toban and player_uuid not in already_exist_player:
-            if playersMapGet(player_uuid) != '-1':
-                player_name = playersMapGet(player_uuid)
-                i += 1
-            else:
-                player_name, i = searchOnline(
-                    player_uuid, i, changed, banlist, banlistIsNew)
-                if player_name == '-3':
-                    print(
-                        "\nAn error occurred while searching the player.Try again later.")
-                    print('Nothing changed.')
-                    sys.exit(0)
-                if player_name == '-2':
-                    print(
-                        "\nAn error occurred while searching the player.Try again later.")
-                    print('Solved '+str(i)+' item<s>.')
-                    sys.exit(0)
-                if player_name == '-1':
-                    # print("\nPlayer: " + player_uuid + " not found! < " +str(i)+" / "+str(banamount)+" >")
-                    player_not_found.append(player_uuid)
-                    progressController(i/banamount * 100)
-                    continue
-                playersMapSave(player_uuid, player_name)
-                i += 1
-
-            # print("Now adding player: " + player_name + " ,UUID: " +player_uuid + " to ban list. < "+str(i)+" / "+str(banamount)+" >")
-            progressController(i/banamount * 100)
-            created = str(time.strftime("%Y-%m-%d %H:%M:%S",
-                          time.localtime())) + " +0800"
-            info = {'uuid': player_uuid, 'name': player_name, 'created': created,
-                    'source': source, 'expires': expires, 'reason': reason}
-            banlist.append(info)  # new ban list
-            changed = True
+    # if a player banned by [MPRDB] recovered , he will be removed from the ban list
+    delta = loadReputationDelta()
+    if args.fullscan or delta is None or delta['full'] or delta['threshold'] != min_point_toban:
+        # the players with a low point are found from the sorted index of local reputation
+        players, points = banCandidates(min_point_toban)
+        delta = {}
+        for player_uuid, point in zip(players, points):
+            delta[player_uuid] = [None, point]
+        candidate = [player_uuid for player_uuid in players if player_uuid not in banlist]
+        recovered = [entry['uuid'] for entry in banlist
+                     if entry['reason'].find('[MPRDB]') >= 0 and entry['uuid'] not in delta]
+    else:
+        # only the players changed since the last ban list are checked
+        delta = delta['players']
+        candidate = []
+        recovered = []
+        for player_uuid in delta:
+            point = delta[player_uuid][1]
+            if point is not None and point <= min_point_toban:
+                if player_uuid not in banlist:
+                    candidate.append(player_uuid)
+            elif player_uuid in banlist and banlist.get(player_uuid)['reason'].find('[MPRDB]') >= 0:
+                recovered.append(player_uuid)
+    for player_uuid in recovered:
+        banlist.remove(player_uuid)
+
+    # search the names not in the players map , all at once before the ban list is assembled
+    # players not found recently are skipped , stale names are used and searched again in background
+    missing = []
+    stale = []
+    player_cached_miss = 0
+    now = time.time()
+    for player_uuid in candidate:
+        status = playersMapStatus(player_uuid, now)
+        if status == 'unknown' or status == 'expired':
+            missing.append(player_uuid)
+        elif status == 'stale':
+            stale.append(player_uuid)
+        elif status == 'miss':
+            player_cached_miss += 1
+    if len(missing) > 0:
+        print('Searching ' + str(len(missing)) + ' player name<s> from mojang...')
+        player_not_found, player_failed = resolvePlayerNames(missing)
+        print('')
+    # started after the names needed now , so it does not take their share of mojang_rate
+    if len(stale) > 0:
+        refreshPlayerNames(stale)
+
+    i = 0
+    for player_uuid in candidate:
+        player_name = playersMapGet(player_uuid)
+        if player_name == '-1':
+            continue
+        i += 1
+        # print("Now adding player: " + player_name + " ,UUID: " +player_uuid + " to ban list.")
+        created = str(time.strftime("%Y-%m-%d %H:%M:%S",
+                      time.localtime())) + " +0800"
+        info = {'uuid': player_uuid, 'name': player_name, 'created': created,
+                'source': source, 'expires': expires, 'reason': reason}
+        banlist.add(info)  # new ban list
 
     if len(player_not_found) > 0:
         print('\nThe players following not found.')
         for items in player_not_found:
             print('  ', items)
+    if player_cached_miss > 0:
+        print('\n' + str(player_cached_miss) + ' player<s> not found before , they will be searched again later.')
+    if len(player_failed) > 0:
+        print('\nAn error occurred while searching the players following. They will be searched again next time.')
+        for items in player_failed:
+            print('  ', items)
+
+    if len(recovered) > 0:
+        print('\n' + str(len(recovered)) + ' player<s> recovered , removed from the ban list.')
 
-    if changed:
+    if banlist.changed():
         print('\nSolved '+str(i)+' item<s>.')
-        backup(banlistIsNew)
+        backup(file_server_banlist, banlistIsNew, banlist_size, banlist)
         newList(banlist)
     else:
         print('\nNothing changed.')
 
+    # the delta is consumed , players without a name yet are kept to be checked again next time
+    unsolved = {}
+    for player_uuid in candidate:
+        if player_uuid not in banlist and player_uuid in delta:
+            unsolved[player_uuid] = delta[player_uuid]
+    if os.path.exists('reputation_delta.json'):
+        os.remove('reputation_delta.json')
+    saveReputationDelta(unsolved, threshold=min_point_toban)
     return 0
 
 
@@ -2046,6 +4094,9 @@ if __name__ == "__main__":
         weight = float(args.weight)
         weightServer(server_uuid, weight)
         print('Set server seight: ' + server_uuid + ' to ' + args.weight)
+        if args.apply:
+            print('Applying the new weight to reputation base...')
+            generateReputationBase()
     elif args.listfrom == True:
         getDetailListFromServer('normal')
     elif args.detail == True:
@@ -2054,5 +4105,9 @@ if __name__ == "__main__":
         updateMainController()
     elif args.push == True:
         pushLocalBanList()
+    elif args.candidates == True:
+        listCandidates()
+    elif args.restore != 'None':
+        restoreBanList(args.restore)
     else:
         print('The main argument is missing!')